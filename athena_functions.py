@@ -1,118 +1,269 @@
-import boto3
+import time
 import logging
 
+import invocations
+
+
+probes = invocations.load_lambda_module('probes')
+
+db_name = 'p40'
+table_name = 'robots'
+bodies_table_name = 'bodies'  # bodies of incremental scans, referenced by hash from the robots table
+bodies_columns = [('hash', 'string'), ('body', 'string')]
+workgroup = 'primary'
+partition_columns = [('scan_date', 'string')]
+first_scan_date = '2020-01-01'
+
+# output_format written by get_robots: (row format clause, serde library reported by Glue)
+table_formats = {'jsonl': ("ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'\n"
+                           "    WITH SERDEPROPERTIES ('serialization.format' = '1')",
+                           'org.openx.data.jsonserde.JsonSerDe'),
+                 'parquet': ("STORED AS PARQUET",
+                             'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe')}
+table_formats['jsonl.gz'] = table_formats['jsonl']  # Athena decompresses .gz files by their extension
+
+price_per_tb_scanned = 5.0  # USD, Athena pricing
+
+
+def query_statistics(query_execution):
+    """
+    Extracts data scanned and timings from a QueryExecution
+    """
+    statistics = query_execution.get('Statistics', {})
+    stats = {'data_scanned_bytes': statistics.get('DataScannedInBytes', 0),
+             'engine_time_ms': statistics.get('EngineExecutionTimeInMillis', 0),
+             'queue_time_ms': statistics.get('QueryQueueTimeInMillis', 0),
+             'total_time_ms': statistics.get('TotalExecutionTimeInMillis', 0)}
+    stats['cost_usd'] = round(stats['data_scanned_bytes'] / 1024 ** 4 * price_per_tb_scanned, 6)
+    return stats
+
+
+def wait_for_executions(execution_ids, client, initial_delay=0.2, max_delay=5.0):
+    """
+    Waits for several Athena queries at once, polling with exponential backoff
+    (batch_get_query_execution checks up to 50 queries per call)
+    returns dict of execution_id: (state, location, stats)
+    location is the output location if the query succeeded, otherwise the reason it failed
+    """
+
+    pending = list(execution_ids)
+    results = {}
+    delay = initial_delay
+
+    while pending:
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+        for k in range(0, len(pending), 50):
+            response = client.batch_get_query_execution(QueryExecutionIds=pending[k:k + 50])
+            for query_execution in response['QueryExecutions']:
+                state = query_execution['Status']['State']
+                if state in ['RUNNING', 'QUEUED']:
+                    continue
+                if state == 'SUCCEEDED':
+                    location = query_execution['ResultConfiguration']['OutputLocation']
+                else:
+                    location = query_execution['Status'].get('StateChangeReason', state)
+                results[query_execution['QueryExecutionId']] = (state, location, query_statistics(query_execution))
+
+        pending = [execution_id for execution_id in pending if execution_id not in results]
+
+    return results
+
 
 def check_execution_status(execution_id, client):
     """
     checks the execution status of a Athena Query
-    loops until a result is available
+    polls with backoff until a result is available
     returns result
     """
 
-    state = 'RUNNING'
-    while state in ['RUNNING', 'QUEUED']:
-        result = client.get_query_execution(QueryExecutionId=execution_id)
-        state = result['QueryExecution']['Status']['State']
+    state, location, stats = wait_for_executions([execution_id], client)[execution_id]
+    return state, location
 
-    if state == 'SUCCEEDED':
-        location = result['QueryExecution']['ResultConfiguration']['OutputLocation']
-    else:
-        location = result['QueryExecution']['Status']['StateChangeReason']
 
-    return state, location
+def start_query(query, bucket_name, client, database=None):
+    """
+    Starts a query without waiting for it, returns its execution id (see wait_for_executions)
+    """
+    kwargs = {'QueryString': query,
+              'ResultConfiguration': {'OutputLocation': f"s3://{bucket_name}/athena"},
+              'WorkGroup': workgroup}
+    if database:
+        kwargs['QueryExecutionContext'] = {'Database': database}
 
+    response = client.start_query_execution(**kwargs)
+    return response['QueryExecutionId']
 
-def create_athena_db(bucket_name, region):
+
+def run_query(query, bucket_name, client, database=None):
+    """
+    Starts a query and waits for it
+    returns state, location and query statistics
+    """
+    execution_id = start_query(query, bucket_name, client, database)
+    return wait_for_executions([execution_id], client)[execution_id]
+
+
+def table_columns(probe_names=None):
+    """
+    Columns of the result records, one per probe (every probe's result is stored as a string)
+    """
+    return [(name, 'string') for name in probes.columns(probe_names)]
+
+
+def create_table_query(bucket_name, output_format='jsonl', probe_names=None, table=table_name):
+    """
+    Generates the table definition matching the files get_robots writes in output_format
+    (table is table_name, or bodies_table_name), files of each table are under a prefix of the same name
+    The scan_date partition is projected, so new scans are queryable without adding partitions
+    """
+    columns = table_columns(probe_names) if table == table_name else bodies_columns
+    columns = ',\n'.join(f"      `{name}` {column_type}" for name, column_type in columns)
+    partitions = ', '.join(f"`{name}` {column_type}" for name, column_type in partition_columns)
+    location = f"s3://{bucket_name}/{table}/"
+    return f'''
+    CREATE EXTERNAL TABLE IF NOT EXISTS {db_name}.{table} (
+{columns}
+    )
+    PARTITIONED BY ({partitions})
+    {table_formats[output_format][0]}
+    LOCATION '{location}'
+    TBLPROPERTIES (
+      'has_encrypted_data'='false',
+      'projection.enabled'='true',
+      'projection.scan_date.type'='date',
+      'projection.scan_date.format'='yyyy-MM-dd',
+      'projection.scan_date.range'='{first_scan_date},NOW',
+      'storage.location.template'='{location}scan_date=${{scan_date}}/'
+    );
+    '''
+
+
+def table_is_current(bucket_name, region, output_format='jsonl', probe_names=None, table=table_name):
+    """
+    Checks the Glue catalog for the robots (or bodies) table
+    returns True if it exists with the expected columns (of probe_names), partitions, format and location
+    """
+    client = invocations.get_context().client('glue', region)
+    try:
+        glue_table = client.get_table(DatabaseName=db_name, Name=table)['Table']
+    except client.exceptions.EntityNotFoundException:
+        return False
+
+    storage = glue_table['StorageDescriptor']
+    columns = [(column['Name'], column['Type']) for column in storage['Columns']]
+    partitions = [(column['Name'], column['Type']) for column in glue_table.get('PartitionKeys', [])]
+    serde = storage.get('SerdeInfo', {}).get('SerializationLibrary')
+    location = storage['Location'].rstrip('/')
+    return (columns == (table_columns(probe_names) if table == table_name else bodies_columns) and
+            partitions == partition_columns and
+            serde == table_formats[output_format][1] and
+            location == f"s3://{bucket_name}/{table}")
+
+
+def create_athena_db(bucket_name, region, output_format='jsonl', probe_names=None):
     """
     creates and Athena database and table
     Database name hardcoded to p40
-    Table name hardcoded to robots
+    Table name hardcoded to robots, with one column per probe in probe_names
+    (plus the bodies table of incremental scans)
+    Skipped if the tables already exist with the right schema
     """
 
     logger = logging.getLogger('__main__')
-    client = boto3.client('athena', region_name=region)
-    workgroup = 'primary'
-    db_name = 'p40'
 
+    if (table_is_current(bucket_name, region, output_format, probe_names) and
+            table_is_current(bucket_name, region, output_format, table=bodies_table_name)):
+        logger.info("Athena Database and Tables already exist, proceeding to query...")
+        return
+
+    client = invocations.get_context().client('athena', region)
     drop_db_query = f"DROP DATABASE IF EXISTS {db_name} CASCADE"
     create_db_query = f"CREATE DATABASE IF NOT EXISTS {db_name} LOCATION 's3://{bucket_name}'"
-    create_table_query = '''
-    CREATE EXTERNAL TABLE IF NOT EXISTS <db_name>.robots (
-      `domain` string,
-      `robots.txt` string 
-    )
-    ROW FORMAT SERDE 'org.openx.data.jsonserde.JsonSerDe'
-    WITH SERDEPROPERTIES (
-      'serialization.format' = '1'
-    ) LOCATION 's3://<bucket_name>/robots/'
-    TBLPROPERTIES ('has_encrypted_data'='false');
-    '''.replace('<bucket_name>', bucket_name).replace('<db_name>', db_name)
-
-    queries = [drop_db_query, create_db_query, create_table_query]
+
+    # the database is dropped and created in order, then both tables are created at once
     logger.info('Creating Athena Database and Tables')
-    for k, query in enumerate(queries):
-        response = client.start_query_execution(QueryString=query,
-                                                ResultConfiguration={'OutputLocation': f"s3://{bucket_name}/athena"},
-                                                WorkGroup=workgroup)
-        result, location = check_execution_status(response['QueryExecutionId'], client)
+    for query in [drop_db_query, create_db_query]:
+        result, location, stats = run_query(query, bucket_name, client)
         if result != 'SUCCEEDED':
             logger.error(f"Failed Executing {query}")
-            break
-        else:
-            pass
+            return
+
+    table_queries = {start_query(query, bucket_name, client): query
+                     for query in [create_table_query(bucket_name, output_format, probe_names),
+                                   create_table_query(bucket_name, output_format, table=bodies_table_name)]}
+    for execution_id, (result, location, stats) in wait_for_executions(list(table_queries), client).items():
+        if result != 'SUCCEEDED':
+            logger.error(f"Failed Executing {table_queries[execution_id]}")
 
     logger.info("Database Created, proceeding to query...")
 
 
-def query_robots(bucket_name, region):
+def incremental_query(probe_names=None):
+    """
+    Select of the robots table of an incremental scan, where GET probes hold the hash of their body:
+    each is joined to the bodies table (bodies can be stored by several scans, hence the group by)
+    """
+    bodies = f'(select hash, arbitrary(body) as body from {db_name}.{bodies_table_name} group by hash)'
+    select = ['r."domain"']
+    joins = []
+    for index, probe in enumerate(probes.get_probes(probe_names)):
+        if probe.method == 'HEAD':
+            select.append(f'r."{probe.name}"')
+        else:
+            select.append(f'b{index}.body as "{probe.name}"')
+            joins.append(f'left join {bodies} b{index} on r."{probe.name}" = b{index}.hash')
+    return f'select {", ".join(select)} from {db_name}.{table_name} r ' + ' '.join(joins)
+
+
+def query_robots(bucket_name, region, scan_date=None, probe_names=None, incremental=False):
     """
     Queries table and returns location where result file is available
     database and table name hardcoded to p40
+    scan_date limits the query to a single scan's partition
+    incremental scans are joined with their bodies, so the result is the same as that of a full scan
     """
-    query = 'select * from p40.robots ORDER BY domain'
-    workgroup = 'primary'
+    if incremental:
+        query = incremental_query(probe_names)
+        if scan_date:
+            query += f" where r.scan_date = '{scan_date}'"
+        query += ' ORDER BY r.domain'
+    else:
+        select = ', '.join(f'"{name}"' for name, column_type in table_columns(probe_names))
+        query = f'select {select} from {db_name}.{table_name}'
+        if scan_date:
+            query += f" where scan_date = '{scan_date}'"
+        query += ' ORDER BY domain'
 
-    client = boto3.client('athena', region_name=region)
+    client = invocations.get_context().client('athena', region)
     logger = logging.getLogger('__main__')
 
-    response = client.start_query_execution(QueryString=query,
-                                            ResultConfiguration={'OutputLocation': f"s3://{bucket_name}/athena"},
-                                            QueryExecutionContext={'Database': 'p40'},
-                                            WorkGroup=workgroup)
-    result, location = check_execution_status(response['QueryExecutionId'], client)
+    result, location, stats = run_query(query, bucket_name, client, database=db_name)
     if result != 'SUCCEEDED':
         logger.info(f"Failed Executing {query}")
     else:
         logger.info(f"Succeeded in Querying bucket. Result Location: {location}")
+    logger.info(f"Query scanned {stats['data_scanned_bytes']:,} bytes (${stats['cost_usd']}), "
+                f"engine time {stats['engine_time_ms']}ms, total time {stats['total_time_ms']}ms")
 
     return location
 
 
 def delete_athena_db(bucket_name, region):
     """
-    creates and Athena database and table
+    deletes the Athena database and table
     Database name hardcoded to p40
-    Table name hardcoded to robots
     """
 
     logger = logging.getLogger('__main__')
-    client = boto3.client('athena', region_name=region)
-    workgroup = 'primary'
-    db_name = 'p40'
+    client = invocations.get_context().client('athena', region)
 
     drop_db_query = f"DROP DATABASE IF EXISTS {db_name} CASCADE"
 
-    queries = [drop_db_query]
-    logger.info('Creating Athena Database and Tables')
-    for k, query in enumerate(queries):
-        response = client.start_query_execution(QueryString=query,
-                                                ResultConfiguration={'OutputLocation': f"s3://{bucket_name}/athena"},
-                                                WorkGroup=workgroup)
-        result, location = check_execution_status(response['QueryExecutionId'], client)
-        if result != 'SUCCEEDED':
-            logger.error(f"Failed Executing {query}")
-            break
-        else:
-            pass
+    logger.info('Deleting Athena Database and Tables')
+    result, location, stats = run_query(drop_db_query, bucket_name, client)
+    if result != 'SUCCEEDED':
+        logger.error(f"Failed Executing {drop_db_query}")
 
-    logger.info("Athena Database Deleted, proceeding to query...")
\ No newline at end of file
+    logger.info("Athena Database Deleted")
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import invocations
+import simulate  # also puts lambda/ on the path, ahead of this directory (see simulate.py)
+import build_layer
+import compress_object
+import result_stream
+import lambda_multiproc
+
+# Micro-benchmarks of the hot paths of a scan, each timed on its own with synthetic data, no AWS needed:
+#   read_rows      rows of a chunk from a 1 million row majestic_million.csv, with and without the layer's index
+#   multiproc      multiproc_requests overhead (process start, pipes) against proc_count, rows do no work
+#   serialization  results of get_robots written through ChunkOutput, the way the asyncio engine does
+#   compression    compress_object's block compression
+#   sqs            split_and_put_into_ques against an SQS stand-in with a fixed latency per call
+#   simulation     end-to-end scan of simulate.py (slower, only run when asked for)
+#
+# Every run is appended to history_file. Runs are compared with baseline_file (written with --save_baseline),
+# metrics that got worse by more than the tolerance are flagged and the script exits with 1.
+
+logger = logging.getLogger('benchmarks')
+logger.setLevel(logging.INFO)
+
+history_file = 'benchmark_history.jsonl'
+baseline_file = 'benchmark_baseline.json'
+default_tolerance = 0.1  # share a metric may get worse by before it's flagged
+
+robots_text = 'User-agent: *\nDisallow: /private/\nDisallow: /tmp/\nSitemap: http://{}/sitemap.xml\n'
+
+
+def metric(value, unit, better):
+    """
+    better is 'higher' or 'lower', which way the metric improves
+    """
+    return {'value': round(value, 3), 'unit': unit, 'better': better}
+
+
+def fastest(func, repeat):
+    """
+    Runs func repeat times, returns the time of the fastest run in seconds (the run least disturbed by the machine)
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def echo_rows(rows):
+    # row function of the multiproc benchmark, no work, so only the engine's overhead is measured
+    return [{'domain': row} for row in rows]
+
+
+def synthetic_results(num_records, seed=0):
+    """
+    Result records like those of get_robots, with robots.txt of varying size
+    """
+    rng = random.Random(seed)
+    selected = simulate.handler.probes.get_probes(['robots.txt'])
+    results = []
+    for n in range(num_records):
+        host = f"example{n}.com"
+        text = robots_text.format(host) + ''.join(f"Disallow: /path{k}/\n" for k in range(rng.randint(0, 60)))
+        results.append(simulate.handler.record(host, selected, {'robots.txt': text}))
+    return results
+
+
+def bench_read_rows(work_dir, options):
+    num_rows = options['rows']
+    per_lambda = 1250
+    csv_file = os.path.join(work_dir, build_layer.csv_name)
+    with open(csv_file, 'w') as f:
+        f.write(simulate.majestic_header + '\n')
+        for rank in range(1, num_rows + 1):
+            f.write(f"{rank},{rank},example{rank}.com,com,100,100,example{rank}.com,com,{rank},{rank},100,100\n")
+
+    # without an index read_rows reads up to the chunk, the last chunk is the worst case
+    sequential = fastest(lambda: lambda_multiproc.read_rows(csv_file, num_rows - per_lambda, num_rows),
+                         options['repeat'])
+    index = fastest(lambda: build_layer.write_index(csv_file), 1)
+
+    starts = random.Random(0).sample(range(num_rows - per_lambda), 20)
+    indexed = fastest(lambda: [lambda_multiproc.read_rows(csv_file, start_pos, start_pos + per_lambda)
+                               for start_pos in starts], options['repeat']) / len(starts)
+    return {'read_rows_sequential_ms': metric(sequential * 1000, 'ms', 'lower'),
+            'read_rows_indexed_ms': metric(indexed * 1000, 'ms', 'lower'),
+            'build_index_seconds': metric(index, 's', 'lower')}
+
+
+def bench_multiproc(work_dir, options):
+    rows = [f"{rank},{rank},example{rank}.com,com\n" for rank in range(options['multiproc_rows'])]
+    results = {}
+    for proc_count in options['proc_counts']:
+        # a pool started for the call, as in a cold container
+        cold = fastest(lambda: lambda_multiproc.multiproc_requests(rows, proc_count, echo_rows,
+                                                                   sink=lambda data: None), options['repeat'])
+        # the pool kept between invocations of a warm container
+        pool = lambda_multiproc.WorkerPool()
+        try:
+            jobs = [(rows, lambda data: None)]
+            lambda_multiproc.multiproc_batch_requests(jobs, proc_count, echo_rows, worker_pool=pool)
+            warm = fastest(lambda: lambda_multiproc.multiproc_batch_requests(jobs, proc_count, echo_rows,
+                                                                             worker_pool=pool), options['repeat'])
+        finally:
+            pool.close()
+        results[f'multiproc_cold_{proc_count}_procs_seconds'] = metric(cold, 's', 'lower')
+        results[f'multiproc_warm_{proc_count}_procs_rows_per_second'] = metric(len(rows) / warm, 'rows/s', 'higher')
+    return results
+
+
+def bench_serialization(work_dir, options):
+    records = synthetic_results(options['records'])
+    s3 = simulate.FakeS3()
+    os.environ['bucket_name'] = simulate.bucket_name
+    output_formats = ['jsonl', 'jsonl.gz'] + (['parquet'] if result_stream.pyarrow is not None else [])
+
+    results = {}
+    for output_format in output_formats:
+        message = {'start_pos': 0, 'end_pos': len(records), 'output_format': output_format, 'scan_date': '2020-01-01'}
+
+        def write_chunk():
+            output = simulate.handler.ChunkOutput(s3, message, None, time.time())
+            for record in records:
+                output.write(result_stream.encode_jsonl([record]))
+            output.close(None, len(records), len(records), 0, [])
+
+        seconds = fastest(write_chunk, options['repeat'])
+        results[f'serialize_{output_format}_records_per_second'] = metric(len(records) / seconds, 'records/s', 'higher')
+    return results
+
+
+class CountingSink:
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def bench_compression(work_dir, options):
+    records = result_stream.encode_jsonl(synthetic_results(5000))
+    data = records * max(1, options['compress_mb'] * 1024 * 1024 // len(records))
+    blocks = [data[k:k + compress_object.block_size] for k in range(0, len(data), compress_object.block_size)]
+    codecs = [('gzip', compress_object.gzip_block)]
+
+    results = {}
+    for name, compress in codecs:
+        sink = CountingSink()
+        seconds = fastest(lambda: compress_object.compress_stream(iter(blocks), compress, sink,
+                                                                  max_workers=os.cpu_count() or 2), options['repeat'])
+        results[f'compress_{name}_mb_per_second'] = metric(len(data) / seconds / 1024 / 1024, 'MB/s', 'higher')
+        results[f'compress_{name}_ratio'] = metric(len(data) / (sink.size / options['repeat']), 'x', 'higher')
+    return results
+
+
+class SlowSQS(simulate.FakeSQS):
+    """
+    SQS stand-in where every send_message_batch takes call_latency seconds, like a call to the real service
+    """
+
+    def __init__(self, queue_names, call_latency):
+        super().__init__(queue_names)
+        self.call_latency = call_latency
+
+    def send_message_batch(self, QueueUrl, Entries):
+        time.sleep(self.call_latency)
+        return super().send_message_batch(QueueUrl, Entries)
+
+
+def bench_sqs(work_dir, options):
+    queue_names = [f"queue{k}" for k in range(5)]
+    sqs = SlowSQS(queue_names, options['sqs_latency'])
+    payload = json.dumps({'start_pos': 0, 'end_pos': 1250, 'proc_count': 125, 'engine': 'asyncio'})
+    messages = [{'MessageBody': payload, 'Id': str(k)} for k in range(options['messages'])]
+    que_urls = [sqs.queue_url(name) for name in queue_names]
+
+    seconds = fastest(lambda: invocations.split_and_put_into_ques(message_batch=messages, que_urls=que_urls,
+                                                                  client=sqs), options['repeat'])
+    return {'sqs_messages_per_second': metric(len(messages) / seconds, 'messages/s', 'higher')}
+
+
+def bench_simulation(work_dir, options):
+    report = simulate.run(domains=2000, slow_timeout=0)
+    return {'simulation_domains_per_second': metric(report['domains_per_second'], 'domains/s', 'higher'),
+            'simulation_p99_ms': metric(report['latency_ms']['p99'], 'ms', 'lower'),
+            'simulation_peak_rss_mb': metric(report['peak_rss_mb'], 'MB', 'lower')}
+
+
+benchmarks = {'read_rows': bench_read_rows,
+              'multiproc': bench_multiproc,
+              'serialization': bench_serialization,
+              'compression': bench_compression,
+              'sqs': bench_sqs,
+              'simulation': bench_simulation}
+default_benchmarks = ['read_rows', 'multiproc', 'serialization', 'compression', 'sqs']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names, options):
+    """
+    Runs the benchmarks in names, returns the history entry of the run
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in names:
+            started = time.time()
+            results.update(benchmarks[name](work_dir, options))
+            logger.info(f"{name} took {time.time() - started:.1f}s")
+
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'options': options,
+            'results': results}
+
+
+def regressions(entry, baseline, tolerance=default_tolerance):
+    """
+    Returns (name, baseline value, value, change) of every metric of entry that is worse than in baseline
+    by more than tolerance (a share of the baseline value)
+    """
+    flagged = []
+    for name, result in entry['results'].items():
+        base = baseline['results'].get(name, {}).get('value')
+        if not base:
+            continue
+        change = (result['value'] - base) / base
+        if (change < -tolerance) if result['better'] == 'higher' else (change > tolerance):
+            flagged.append((name, base, result['value'], change))
+    return flagged
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    logging.getLogger('main_logger').setLevel(logging.CRITICAL)
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the hot paths of a scan")
+    parser.add_argument("names",
+                        help=f"Benchmarks to run, default is {' '.join(default_benchmarks)}",
+                        nargs='*',
+                        default=default_benchmarks)
+    parser.add_argument("-r", "--repeat",
+                        help="Times each measurement is repeated, the fastest counts, default is 3",
+                        default=3)
+    parser.add_argument("--rows",
+                        help="Rows of the csv of the read_rows benchmark, default is 1000000",
+                        default=1000000)
+    parser.add_argument("--proc_counts",
+                        help="Values of proc_count of the multiproc benchmark, default is 1 8 32 125",
+                        nargs='+',
+                        default=[1, 8, 32, 125])
+    parser.add_argument("--tolerance",
+                        help=f"Share a metric may get worse by before it's flagged, default is {default_tolerance}",
+                        default=default_tolerance)
+    parser.add_argument("--save_baseline",
+                        help=f"Save this run as the baseline ({baseline_file}) to compare later runs with",
+                        action='store_true')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in benchmarks]
+    if unknown:
+        parser.error(f"Unknown benchmarks {', '.join(unknown)}, choose from {', '.join(benchmarks)}")
+
+    options = {'repeat': int(args.repeat),
+               'rows': int(args.rows),
+               'proc_counts': [int(proc_count) for proc_count in args.proc_counts],
+               'multiproc_rows': 2000,
+               'records': 20000,
+               'compress_mb': 64,
+               'messages': 8000,
+               'sqs_latency': 0.02}
+    entry = run(args.names, options)
+    with open(history_file, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+    baseline = None
+    if os.path.exists(baseline_file):
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)
+        if (baseline['python'], baseline['cpu_count']) != (entry['python'], entry['cpu_count']):
+            logger.warning(f"Baseline was taken with python {baseline['python']} on {baseline['cpu_count']} cpus, "
+                           f"not comparable with this machine")
+
+    for name, result in entry['results'].items():
+        base = baseline['results'].get(name, {}).get('value') if baseline else None
+        compared = f" (baseline {base})" if base is not None else ''
+        print(f"{name:50} {result['value']:>14,} {result['unit']}{compared}")
+
+    flagged = regressions(entry, baseline, float(args.tolerance)) if baseline else []
+    for name, base, value, change in flagged:
+        logger.warning(f"REGRESSION {name}: {base} -> {value} ({change:+.1%})")
+
+    if args.save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(entry, f, indent=2)
+        logger.info(f"Saved as baseline in {baseline_file}")
+
+    sys.exit(1 if flagged else 0)
@@ -6,8 +6,7 @@ import uuid
 import logging
 import argparse
 
-import boto3
-
+import planner
 import invocations
 import athena_functions
 
@@ -35,62 +34,223 @@ if __name__ == '__main__':
     parser.add_argument("-m", "--multiproc_count",
                         help="Number of multi-processes per lambda, default is 125",
                         default=2)
+    parser.add_argument("-e", "--engine",
+                        help="Scan engine used in each lambda, asyncio or multiproc, default is asyncio",
+                        choices=['asyncio', 'multiproc'],
+                        default='asyncio')
+    parser.add_argument("-c", "--concurrency",
+                        help="Number of requests in flight per lambda (asyncio engine), default is 500",
+                        default=500)
+    parser.add_argument("-t", "--timeout",
+                        help="Per-request timeout in seconds (asyncio engine), default is 1.5",
+                        default=1.5)
+    parser.add_argument("-s", "--slow_timeout",
+                        help="Timeout in seconds for retrying timed out domains in the slow lane, 0 disables it, "
+                             "default is 5",
+                        default=5)
+    parser.add_argument("--slow_concurrency",
+                        help="Number of requests in flight per lambda in the slow lane, default is 800",
+                        default=800)
+    # parquet needs pyarrow, which isn't deployed to the function (simulate.py can write it with a local pyarrow)
+    parser.add_argument("-o", "--output_format",
+                        help="Format of result files, jsonl or jsonl.gz, default is jsonl",
+                        choices=['jsonl', 'jsonl.gz'],
+                        default='jsonl')
+    parser.add_argument("--probes",
+                        help="What to request from every domain, each probe becomes a column of the results, "
+                             "default is robots.txt",
+                        nargs='+',
+                        choices=list(athena_functions.probes.available),
+                        default=athena_functions.probes.default_probes)
+    parser.add_argument("-i", "--incremental",
+                        help="Keep earlier scans, and only download what changed since the previous one",
+                        action='store_true')
+    parser.add_argument("-d", "--domains",
+                        help="Plan the scan instead: number of domains to scan, -n, -p and -m (or -c) are picked "
+                             "from the throughput of earlier scans, and concurrency is reserved to match",
+                        default=None)
+    parser.add_argument("-b", "--budget",
+                        help="Seconds the planned scan should finish in, default is 300",
+                        default=300)
 
+    parser.add_argument("-r", "--regions",
+                        help="Shard the scan across the stacks deployed in these regions, in proportion to the "
+                             "concurrency available in each, default is aws_region of serverless.yml",
+                        nargs='+',
+                        default=None)
     args = parser.parse_args()
 
     num_invocations = int(args.num_invocations)
     per_lambda = int(args.per_lambda)
     proc_count = int(args.multiproc_count)
+    concurrency = int(args.concurrency)
+    timeout = float(args.timeout)
     total_urls = num_invocations * per_lambda
+    scan_date = time.strftime('%Y-%m-%d', time.gmtime())
 
     payloads = []
 
-    # clear the bucket before we start
-    logger.info("Clearing bucket before beginning....")
-    invocations.clear_bucket()
-
     # Get Configuration
     config = invocations.get_config()
-    bucket_name = invocations.get_bucket_name()
-    region = config['custom']['aws_region']
     service_name = config['service']
     queue_names = config['queue_names']
     dl_queue = config['custom']['dlQueueName']
     stage_name = config['custom']['stage']
-    logger.info(f'Using Serverless deployment {service_name}')
+    function_name = f"{service_name}-{stage_name}-get_robots"
+    regions = invocations.discover_stacks(args.regions or [config['custom']['aws_region']])
+    if not regions:
+        raise SystemExit("No stack to scan with")
+    logger.info(f'Using Serverless deployment {service_name} in {", ".join(regions)}')
     logger.info(f'Using SQS Queues: {queue_names}')
 
+    if args.incremental:
+        # keep earlier scans, only clear what this scan will write again
+        # every region keeps the state of the rows it scanned, so each has its own previous scan
+        previous_scans = invocations.in_regions(lambda region: invocations.previous_scan(scan_date, region=region),
+                                                regions)
+        for region, previous_scan in previous_scans.items():
+            logger.info(f"{region}: incremental scan, changes since "
+                        f"{previous_scan or 'nothing (first incremental scan)'}")
+        prefixes = ['status/', 'failures/', 'metrics/'] + [f"{table}/scan_date={scan_date}/"
+                                                           for table in ['robots', 'bodies', 'state']]
+        invocations.in_regions(lambda region: [invocations.clear_bucket(prefix, region) for prefix in prefixes],
+                               regions)
+    else:
+        # clear the bucket before we start
+        previous_scans = dict.fromkeys(regions)
+        logger.info("Clearing bucket before beginning....")
+        invocations.in_regions(lambda region: invocations.clear_bucket(region=region), regions)
+
+    # concurrency the scan function can reserve in every region, chunks are shared out in proportion to it
+    if args.domains or len(regions) > 1:
+        capacities = invocations.in_regions(
+            lambda region: planner.available_concurrency(invocations.get_context(region).client('lambda'),
+                                                         function_name),
+            regions)
+        logger.info(f"Available concurrency: {capacities}")
+    else:
+        capacities = {regions[0]: 1}
+
+    if args.domains:
+        setting, rate = planner.measured_rate(planner.load_history(), args.engine)
+        plan = planner.plan(total_domains=int(args.domains),
+                            budget=float(args.budget),
+                            concurrency_limit=sum(capacities.values()),
+                            rate=rate,
+                            batch_size=int(config['custom']['batchSize']),
+                            function_timeout=int(config['custom']['functionTimeout']))
+        num_invocations, per_lambda = plan['num_invocations'], plan['per_lambda']
+        if args.engine == 'multiproc':
+            proc_count = setting
+        else:
+            concurrency = setting
+        total_urls = num_invocations * per_lambda
+        for region, concurrent in planner.shard(plan['concurrent'], capacities).items():
+            # concurrent is capped at what the region can reserve (available_concurrency), so reserve exactly that
+            invocations.set_concurrency(concurrent, invocations.get_context(region).client('lambda'), function_name,
+                                        headroom=0)
+
     # Create Payloads
     for x in range(int(num_invocations)):
         payloads.append({'start_pos': x * per_lambda,
                          'end_pos': (x+1) * per_lambda,
-                         'proc_count': proc_count})  # proc_count is the number of processes per lambda
+                         'proc_count': proc_count,  # proc_count is the number of processes per lambda
+                         'engine': args.engine,
+                         'concurrency': concurrency,
+                         'timeout': timeout,
+                         'slow_timeout': float(args.slow_timeout),
+                         'slow_concurrency': int(args.slow_concurrency),
+                         'output_format': args.output_format,
+                         'probes': args.probes,
+                         'incremental': args.incremental,
+                         'scan_date': scan_date})
+
+    # Shard the payloads, every region scans a contiguous range of rows
+    region_payloads = {}
+    for region, num_chunks in planner.shard(len(payloads), capacities).items():
+        taken = sum(len(shard) for shard in region_payloads.values())
+        region_payloads[region] = [dict(payload, previous_scan=previous_scans[region])
+                                   for payload in payloads[taken:taken + num_chunks]]
+        logger.info(f"{region}: {num_chunks} chunks")
+    regions = [region for region in regions if region_payloads[region]]
 
     # Package Payloads into SQS Messages
-    sqs_messages = [{'MessageBody': json.dumps(payload),
-                     'Id': uuid.uuid4().__str__()} for payload in payloads]
+    sqs_messages = {region: [{'MessageBody': json.dumps(payload),
+                              'Id': uuid.uuid4().__str__()} for payload in region_payloads[region]]
+                    for region in regions}
 
     _start = time.time()
-    invocations.put_sqs(sqs_messages, queue_names)
-    invocations.check_dead_letter(dl_queue)
+    # dead letters of earlier scans are still on the queue, only those added from now on are this scan's
+    dead_letters = invocations.in_regions(lambda region: invocations.check_dead_letter(dl_queue, log=False,
+                                                                                      region=region),
+                                          regions)
+    enqueued = invocations.in_regions(lambda region: invocations.put_sqs(sqs_messages[region], queue_names, region),
+                                      regions)
+    for region in regions:
+        if enqueued[region] < len(sqs_messages[region]):
+            logger.error(f"{region}: only {enqueued[region]} of {len(sqs_messages[region])} chunks were enqueued, "
+                         f"the rows of the others are not scanned")
+    # chunks that were never enqueued won't write a completion marker, so only wait for those that were
+    reports = invocations.in_regions(lambda region: invocations.track_completion(
+        enqueued[region], dl_queue, region=region, dead_letters_before=dead_letters[region]), regions)
+    report = invocations.merge_reports(reports.values())
+    metrics_report = invocations.collect_metrics(regions=regions)
+    logger.info(f"Outcomes of requests in {metrics_report['invocations']} invocations: {metrics_report['outcomes']}, "
+                f"{metrics_report['bytes']:,} bytes, workers {metrics_report['workers']}")
+    for phase, stats in metrics_report['phases'].items():
+        logger.info(f"{phase:>8}: {stats['count']:,} timed, mean {stats['mean']}ms, "
+                    f"p50 <={stats['p50']}ms, p95 <={stats['p95']}ms, p99 <={stats['p99']}ms")
+    with open('request_metrics.json', 'w') as f:
+        json.dump(metrics_report, f, indent=2)
+    planner.record_scan(report, args.engine, proc_count if args.engine == 'multiproc' else concurrency,
+                        per_lambda, int(config['custom']['batchSize']))
     _end = time.time()
     print("\nTime Taken to process {:,} urls is {}s\n".format(total_urls,
                                                           time.time() - _start))
 
-    # Use Athena to query S3 Bucket
-    athena_functions.create_athena_db(bucket_name, region)
-    result_file = athena_functions.query_robots(bucket_name, region)
-    result_file_key = result_file.replace(f's3://{bucket_name}/', '')
-    print("\nTime Taken to query {:,} file is {}s\n".format(len(sqs_messages),
+    # Use Athena to query the S3 Bucket of every region
+    def query(region):
+        bucket_name = invocations.get_bucket_name(region)
+        athena_functions.create_athena_db(bucket_name, region, args.output_format, args.probes)
+        result_file = athena_functions.query_robots(bucket_name, region, scan_date, args.probes, args.incremental)
+        return result_file.replace(f's3://{bucket_name}/', '')
+
+    result_file_keys = invocations.in_regions(query, regions)
+    print("\nTime Taken to query {:,} file is {}s\n".format(len(payloads),
                                                         time.time() - _start))
 
-    # Compress result file
-    results = invocations.sync_in_region(function_name=f"{service_name}-{stage_name}-compress_object",
-                                         payloads=[{'result_file': result_file_key}])
+    # Compress result files
+    results = invocations.fan_out(function_name=f"{service_name}-{stage_name}-compress_object",
+                                  payloads={region: [{'result_file': key}] for region, key in result_file_keys.items()})
+    result_keys = {}
+    for result in results:
+        # fan_out has logged the failed invocations, their region's results are left out
+        if 'error' in result or not isinstance(result.get('resp_payload'), str):
+            logger.error(f"Compressing the results in {result['region']} failed, they are not downloaded")
+            continue
+        bucket_name = invocations.get_bucket_name(result['region'])
+        result_keys[result['region']] = result['resp_payload'].replace(f's3://{bucket_name}/', '')
+    compressed = [region for region in regions if region in result_keys]
+    if not compressed:
+        raise SystemExit("No results to download")
+
+    if len(compressed) == 1:
+        result_key = result_keys[compressed[0]]
+        logger.info(f'Downloading {result_key}')
+        invocations.get_context(compressed[0]).client('s3').download_file(invocations.get_bucket_name(compressed[0]),
+                                                                         result_key, result_key)
+    else:
+        # every region has the results of its shard, download them all and merge them into one file
+        def download(region):
+            part_file = f"{region}.{result_keys[region]}"
+            logger.info(f'Downloading {result_keys[region]} from {region}')
+            invocations.get_context(region).client('s3').download_file(invocations.get_bucket_name(region),
+                                                                      result_keys[region], part_file)
+            return part_file
 
-    result_key = results[0]['resp_payload'].replace(f's3://{bucket_name}/', '')
-    logger.info(f'Downloading {result_key}')
-    s3 = boto3.resource('s3')
-    s3.meta.client.download_file(bucket_name, result_key, result_key)
+        part_files = invocations.in_regions(download, compressed)
+        result_key = invocations.merge_results([part_files[region] for region in compressed],
+                                               result_keys[compressed[0]])
+        logger.info(f'Merged the results of {len(compressed)} regions into {result_key}')
 
     print("\nTime Taken to for entire operation: {}s\n".format(time.time() - _start))
@@ -1,57 +1,185 @@
+import csv
 import json
 import yaml
 import boto3
+import botocore.config
+import botocore.exceptions
 import os
+import gzip
+import heapq
 import time
+import shutil
+import threading
 import concurrent.futures
 import base64
 import logging
+import importlib.util
+
+
+def load_lambda_module(name):
+    """
+    Loads lambda/<name>.py, for the modules of the lambda functions the driver shares (standard library only)
+    (lambda is a keyword, so the directory can't be imported as a package)
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda', f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+scan_metrics = load_lambda_module('scan_metrics')
+bulk_objects = load_lambda_module('bulk_objects')  # shared with the clear_bucket function
 
 configuration_file = 'lambda/serverless.yml'
 status_file = 'lambda/status.json'
 result_folder = 'result'
+status_prefix = 'status/'  # completion markers written by get_robots for each chunk
 
 
-def get_config():
+class Context:
+    """
+    Parses the serverless configuration once, and caches everything derived from it:
+    the bucket name (from CloudFormation), queue urls and boto3 clients
+
+    Clients are created from one boto3 session with a connection pool large enough for the
+    thread pools used in this module, and are safe to share between threads once created.
+
+    The stack is the one deployed in region (defaults to aws_region of the configuration),
+    scans sharded across regions have a Context per region.
+    """
+
+    def __init__(self, config_file=configuration_file, max_pool_connections=50, region=None):
+        self.config_file = config_file
+        self.max_pool_connections = max_pool_connections
+        self._region = region
+        self.session = boto3.session.Session()
+        self.lock = threading.RLock()  # boto3 sessions are not thread-safe, guard client creation
+        self._config = None
+        self._bucket_name = None
+        self._clients = {}
+        self._queue_urls = {}
+
+    @property
+    def config(self):
+        if self._config is None:
+            # use the much faster libyaml loader when PyYAML was built with it
+            loader = getattr(yaml, 'CLoader', yaml.Loader)
+            with open(self.config_file, 'r') as sls_config:
+                config = yaml.load(sls_config.read(), Loader=loader)
+
+            # modify Queue Names
+            config['queue_names'] = [config['custom'][name]
+                                     for name in config['custom'].keys() if name.startswith('queue')]
+            self._config = config
+
+        return self._config
+
+    @property
+    def region(self):
+        return self._region or self.config['custom']['aws_region']
+
+    def client(self, service, region=None, **config):
+        """
+        Returns a shared boto3 client for service in region (defaults to the configured region)
+        config overrides the botocore config of the client (e.g. max_pool_connections, read_timeout),
+        clients with different overrides are separate clients
+        """
+        config = dict({'max_pool_connections': self.max_pool_connections}, **config)
+        key = (service, region or self.region, tuple(sorted(config.items())))
+        with self.lock:
+            if key not in self._clients:
+                self._clients[key] = self.session.client(service, region_name=key[1],
+                                                         config=botocore.config.Config(**config))
+        return self._clients[key]
+
+    @property
+    def bucket_name(self):
+        """
+        Gets random bucket name from CloudFormation stack
+        """
+        with self.lock:
+            if self._bucket_name is None:
+                stack_name = f"{self.config['service']}-{self.config['custom']['stage']}"
+                response = self.client('cloudformation').describe_stack_resources(StackName=stack_name)
+                self._bucket_name = [resource['PhysicalResourceId']
+                                     for resource in response['StackResources']
+                                     if resource['LogicalResourceId'] == 'p40Bucket'][0]
+        return self._bucket_name
+
+    def queue_url(self, queue_name):
+        with self.lock:
+            if queue_name not in self._queue_urls:
+                response = self.client('sqs').get_queue_url(QueueName=f"{queue_name}")
+                self._queue_urls[queue_name] = response['QueueUrl']
+        return self._queue_urls[queue_name]
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_context(region=None):
+    """
+    Returns the Context of region (default is the configured region) shared by all functions in this module,
+    created on first use
+    """
+    with _contexts_lock:
+        if region not in _contexts:
+            _contexts[region] = Context(region=region)
+        return _contexts[region]
 
-    with open(configuration_file, 'r') as sls_config:
-        config = yaml.load(sls_config.read(), Loader=yaml.Loader)
 
-    # modify Queue Names
-    config['queue_names'] = [config['custom'][name] for name in config['custom'].keys() if name.startswith('queue')]
+def get_config():
 
-    return config
+    return get_context().config
 
 
-def get_bucket_name():
+def get_bucket_name(region=None):
     """
     Gets random bucket name from CloudFormation stack
     :return: bucket_name
     """
 
-    config = get_config()
-    region = config['custom']['aws_region']
-    client = boto3.client('cloudformation', region_name=region)
+    return get_context(region).bucket_name
 
-    stack_name = f"{config['service']}-{config['custom']['stage']}"
 
-    response = client.describe_stack_resources(StackName=stack_name)
+def discover_stacks(regions):
+    """
+    Returns the regions (of regions) the stack is deployed in, logs the others
+    """
+    logger = logging.getLogger('__main__')
+    found = []
+    for region in regions:
+        try:
+            get_bucket_name(region)
+            found.append(region)
+        except botocore.exceptions.ClientError as e:
+            logger.error(f"No stack found in {region} ({e.response['Error']['Code']}), "
+                         f"deploy it with: cd lambda && sls deploy --region {region}")
+    return found
 
-    bucket_name = [resource['PhysicalResourceId']
-                   for resource in response['StackResources']
-                   if resource['LogicalResourceId'] == 'p40Bucket'][0]
 
-    return bucket_name
+def in_regions(func, regions):
+    """
+    Calls func(region) for every region at once, returns dict of region: result
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(regions))) as executor:
+        return dict(zip(regions, executor.map(func, regions)))
 
 
-def set_concurrency(num_payloads, lambda_client, function_name):
+def set_concurrency(num_payloads, lambda_client, function_name, headroom=10):
+    """
+    Reserves num_payloads + headroom concurrent executions for function_name (if there are 100 or more),
+    the planner passes headroom=0 as it already plans up to the concurrency that can be reserved
+    """
 
     if num_payloads < 100:
         return None
     else:
         print("{} functions to be invoked, reserving concurrency".format(num_payloads))
         response = lambda_client.put_function_concurrency(FunctionName=function_name,
-                                                          ReservedConcurrentExecutions=num_payloads + 10)
+                                                          ReservedConcurrentExecutions=num_payloads + headroom)
         print("{} now has {} reserved concurrent executions".format(function_name,
                                                                     response['ReservedConcurrentExecutions']))
         return None
@@ -64,104 +192,166 @@ def calc_concurrency(num_payloads):
         return num_payloads
 
 
-def clear_bucket():
-    """ 
-    Deletes all objects in Bucket
+def clear_bucket(prefix='', region=None):
+    """
+    Deletes all objects in Bucket (or only those under prefix, e.g. 'robots/')
     use it wisely
     """
-    config = get_config()
+    context = get_context(region)
+    bucket_name = context.bucket_name
 
-    region = config['custom']['aws_region']
-    bucket_name = get_bucket_name()
+    num_deleted = bulk_objects.delete_objects(context.client('s3'), bucket_name, prefix=prefix)
 
-    s3_client = boto3.client('s3', region_name=region)
-
-    kwargs = {'Bucket': bucket_name}
-
-    while True:
-        resp = s3_client.list_objects_v2(**kwargs)
-        keys = []
-
-        for obj in resp.get('Contents', []):
-            keys.append({'Key': obj['Key']})
-
-        if len(keys) > 0:
-            s3_client.delete_objects(Bucket=bucket_name,
-                                     Delete={'Objects': keys})
-        else:
-            pass
+    print("Deleted {} objects, bucket {} is empty".format(num_deleted, bucket_name + '/' + prefix))
+    return None
 
-        # try the next iteration, (list_objects_v2 only returns first 1000 entries)
-        try:
-            kwargs['ContinuationToken'] = resp['NextContinuationToken']
-        except KeyError:
-            break
 
-    print("Bucket {} is empty".format(bucket_name))
-    return None
+def previous_scan(scan_date, prefix='state/', region=None):
+    """
+    Returns the latest scan_date before scan_date that has a partition under prefix, or None
+    (partitions are named prefix + 'scan_date=YYYY-MM-DD/', so the dates sort as strings)
+    """
+    context = get_context(region)
+    paginator = context.client('s3').get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=context.bucket_name, Prefix=prefix + 'scan_date=', Delimiter='/')
+    scan_dates = [common_prefix['Prefix'][len(prefix):].strip('/').split('=', 1)[1]
+                  for page in pages
+                  for common_prefix in page.get('CommonPrefixes', [])]
+    earlier = [date for date in scan_dates if date < scan_date]
+    return max(earlier) if earlier else None
 
 
-def download_bucket():
+def download_bucket(prefix=''):
 
     """
-    Download all files from a bucket into the result_folder on local machine
+    Download all files from a bucket (or only those under prefix) into the result_folder on local machine
     Script will delete all items in result_folder before downloading
     :return:
     """
 
-    bucket_name = get_bucket_name()
-    config = get_config()
-    region = config['custom']['aws_region']
+    context = get_context()
+    bucket_name = context.bucket_name
 
-    s3_client = boto3.client('s3', region_name=region)
+    # delete all items in the result folder on local machine, and download bucket
+    shutil.rmtree(result_folder, ignore_errors=True)
+    os.makedirs(result_folder)
 
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        keys = [content['Key'] for content in response['Contents']]
-        print("Found {} files, waiting ...".format(len(keys)))
-    except KeyError:
+    print("Downloading all files from bucket")
+    file_names = bulk_objects.download_objects(context.client('s3'), bucket_name, result_folder, prefix=prefix)
+    if not file_names:
         print("No Files Found")
         return False
 
-    print("Found %d items in S3...ending" % len(keys))
-    s3 = boto3.resource('s3', region_name=region)
-    print("Downloading all files from bucket")
-
-    # delete all items in the result folder on local machine, and download bucket
-    list(map(os.unlink, (os.path.join(result_folder, f) for f in os.listdir(result_folder))))
-    for key in keys:
-        s3.Bucket(config['bucket_name']).download_file(key, result_folder + '/{}'.format(key))
-
+    print("Downloaded {} files into {}".format(len(file_names), result_folder))
+    return True
 
-def sync_in_region(function_name, payloads, region_name=False, max_workers=1, log_type='None'):
-
-    # if no region specified use region
-    if not region_name:
-        config = get_config()
-        region_name = config['custom']['aws_region']
-
-    lambda_client = boto3.client('lambda', region_name=region_name)
-    print("Invoking Lambdas in {}".format(region_name))
-
-    results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(lambda_client.invoke,
-                                   FunctionName=function_name,
-                                   InvocationType="RequestResponse",
-                                   LogType=log_type,
-                                   Payload=json.dumps(payload)) for payload in payloads]
 
+def merge_results(part_files, result_file):
+    """
+    Merges the gzipped CSV results of several regions into result_file, keeping the header of the first only,
+    and deletes the parts. Every part is ordered by domain (the first column, see athena_functions.query_robots),
+    they are merged so the result is too, as if the scan had run in one region
+    """
+    csv.field_size_limit(2 ** 31 - 1)  # bodies of probes can be larger than the default limit
+    parts = [gzip.open(part_file, 'rt', encoding='utf-8', newline='') for part_file in part_files]
+    try:
+        readers = [csv.reader(part) for part in parts]
+        headers = [next(reader, None) for reader in readers]
+        with gzip.open(result_file, 'wt', encoding='utf-8', newline='') as merged:
+            writer = csv.writer(merged, quoting=csv.QUOTE_ALL, lineterminator='\n')  # written like Athena's results
+            writer.writerow(headers[0])
+            writer.writerows(heapq.merge(*readers, key=lambda row: row[0]))
+    finally:
+        for part in parts:
+            part.close()
+    for part_file in part_files:
+        os.remove(part_file)
+    return result_file
+
+
+def invoke(lambda_client, function_name, payload, invocation_type, log_type):
+    """
+    Invokes function_name once, returns the result dict yielded by fan_out (without region and index)
+    """
+    try:
+        response = lambda_client.invoke(FunctionName=function_name,
+                                        InvocationType=invocation_type,
+                                        LogType=log_type,
+                                        Payload=json.dumps(payload))
+    except Exception as e:  # one failed invocation must not end the fan out
+        return {'status_code': None, 'error': f"{type(e).__name__} {e}"}
+
+    body = response['Payload'].read().decode('utf-8')
+    result = {'status_code': response['StatusCode'],
+              'resp_payload': json.loads(body) if body else None}
+    if 'FunctionError' in response:
+        result['error'] = response['FunctionError']
+    if 'LogResult' in response:
+        result['log_result'] = base64.b64decode(response['LogResult']).decode('utf-8', errors='replace')
+    return result
+
+
+def fan_out(function_name, payloads, regions=None, invocation_type='RequestResponse', max_workers=10,
+            log_type='None'):
+    """
+    Args:
+        function_name: name of the function, the same in every region
+        payloads: list of payloads, one invocation each, spread over regions in turn
+                  or dict of region: list of payloads for that region
+        regions: regions to invoke in (defaults to the configured region), if payloads is a list
+        invocation_type: 'RequestResponse' to wait for every function's response,
+                         or 'Event' to only queue the invocations (resp_payload is None)
+        max_workers: invocations in flight per region, each region has its own threads and client
+                     with a connection pool of that size
+        log_type: 'Tail' to include the end of each invocation's log (RequestResponse only)
+    Invokes in all regions at once, and yields the result of every invocation as soon as it completes
+    :return
+        generator of dicts of region, index (position of the payload in payloads, or in its region's list),
+        status_code, resp_payload (decoded JSON), error (if the invocation or the function failed)
+        and log_result (with log_type 'Tail')
+    """
+    context = get_context()
+    logger = logging.getLogger('__main__')
+    if isinstance(payloads, dict):
+        jobs = [(region, index, payload)
+                for region, region_payloads in payloads.items()
+                for index, payload in enumerate(region_payloads)]
+    else:
+        regions = regions or [context.region]
+        jobs = [(regions[index % len(regions)], index, payload) for index, payload in enumerate(payloads)]
+
+    executors = {region: concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+                 for region in sorted({region for region, index, payload in jobs})}
+    # RequestResponse invocations can take as long as the function's timeout (up to 900s)
+    clients = {region: context.client('lambda', region, max_pool_connections=max_workers, read_timeout=900)
+               for region in executors}
+    logger.info(f"Invoking {function_name} {len(jobs)} times ({invocation_type}) in {', '.join(executors)}")
+
+    futures = {executors[region].submit(invoke, clients[region], function_name, payload,
+                                        invocation_type, log_type): (region, index)
+               for region, index, payload in jobs}
+    try:
         for future in concurrent.futures.as_completed(futures):
-            resp_payload = future.result()['Payload'].read().decode('utf-8')
-
-            if log_type == 'None':
-                results.append({'resp_payload': resp_payload[1:-1]})
-            else:
-                log_result = base64.b64decode(future.result()['LogResult'])
-                results.append({'resp_payload': resp_payload[1:-1],
-                                'log_result': log_result})
-
-    return results
+            region, index = futures[future]
+            result = dict(future.result(), region=region, index=index)
+            if 'error' in result:
+                logger.error(f"Invocation {index} of {function_name} in {region} failed: {result['error']}")
+            yield result
+    finally:
+        # if the caller stops early, invocations that haven't started are dropped
+        for future in futures:
+            future.cancel()
+        for executor in executors.values():
+            executor.shutdown()
+
+
+def sync_in_region(function_name, payloads, region_name=False, max_workers=10, log_type='None'):
+    """
+    Invokes function_name once per payload in region_name (defaults to the configured region)
+    and waits for all of them, returns the list of results of fan_out
+    """
+    regions = [region_name] if region_name else None
+    return list(fan_out(function_name, payloads, regions=regions, max_workers=max_workers, log_type=log_type))
 
 
 def check_queue(queue_name):
@@ -171,11 +361,11 @@ def check_queue(queue_name):
     Checks queue for messages, logs queue status of messages left on que and hidden messages
     returns only when queue is empty
     """
-    region = get_config()['provider']['region']
-    client = boto3.client('sqs', region_name=region)
+    context = get_context()
+    client = context.client('sqs')
     logger = logging.getLogger('__main__')
 
-    que_url = client.get_queue_url(QueueName=f"{queue_name}")['QueueUrl']
+    que_url = context.queue_url(queue_name)
     response = client.get_queue_attributes(QueueUrl=que_url,
                                            AttributeNames=['ApproximateNumberOfMessages',
                                                            'ApproximateNumberOfMessagesNotVisible'])
@@ -187,113 +377,256 @@ def check_queue(queue_name):
     return num_messages_on_que, num_messages_hidden
 
 
-def check_dead_letter(queue_name):
+def check_dead_letter(queue_name, log=True, region=None):
     """
     Args:
         queue_name : queue_name of the dead letter queue
+        log : log the number of dead letters found
+        region : region of the stack, default is the configured region
     """
 
-    region = get_config()['custom']['aws_region']
-    client = boto3.client('sqs', region_name=region)
+    context = get_context(region)
+    client = context.client('sqs')
     logger = logging.getLogger('__main__')
 
-    que_dl_url = client.get_queue_url(QueueName=f"{queue_name}")['QueueUrl']
+    que_dl_url = context.queue_url(queue_name)
     response = client.get_queue_attributes(QueueUrl=que_dl_url,
                                            AttributeNames=['ApproximateNumberOfMessages',
                                                            'ApproximateNumberOfMessagesNotVisible'])
     num_dead_letters = int(response['Attributes']['ApproximateNumberOfMessages'])
-    if num_dead_letters == 0:
-        logger.info("No Dead Letters found. All Que messages successfully processed")
-    else:
-        logger.info(f"{num_dead_letters} messages failed. Check dead letter que for more info")
+    if log:
+        if num_dead_letters == 0:
+            logger.info("No Dead Letters found. All Que messages successfully processed")
+        else:
+            logger.info(f"{num_dead_letters} messages failed. Check dead letter que for more info")
 
     return num_dead_letters
 
 
-def put_sqs(message_batch, queue_names):
+def put_sqs(message_batch, queue_names, region=None):
     """
     Args:
         message_batch : list of messages to be sent to the que
         queue_names (list) : names of ques to be put on
+        region : region of the stack, default is the configured region
+    :return
+        num_messages_success: Number of messages successfully put onto the ques
     """
 
-    region = get_config()['custom']['aws_region']
-    client = boto3.client('sqs', region_name=region)
+    client = get_context(region).client('sqs')
     logger = logging.getLogger('__main__')
-    que_urls = get_queue_url(queue_names)
+    que_urls = get_queue_url(queue_names, region)
 
-    logger.info(f"Putting {len(message_batch)} messages onto Ques")
+    logger.info(f"Putting {len(message_batch)} messages onto Ques in {get_context(region).region}")
     num_messages_success = split_and_put_into_ques(message_batch=message_batch, que_urls=que_urls, client=client)
 
-    logger.info("Checking SQS Que....")
+    return num_messages_success
 
-    poll_count = 0
-    while True:
 
-        poll_count += 1
-        num_messages_on_que = 0
-        num_messages_hidden = 0
+def read_status(s3_client, bucket_name, key):
+    response = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return json.loads(response['Body'].read())
 
-        for que_url in que_urls:
-            response = client.get_queue_attributes(QueueUrl=que_url,
-                                                   AttributeNames=['ApproximateNumberOfMessages',
-                                                                   'ApproximateNumberOfMessagesNotVisible'])
-            num_messages_on_que += int(response['Attributes']['ApproximateNumberOfMessages'])
-            num_messages_hidden += int(response['Attributes']['ApproximateNumberOfMessagesNotVisible'])
 
-        if num_messages_on_que == 0 and num_messages_hidden == 0:
-            logger.info(f"{num_messages_on_que} messages left on Que, {num_messages_hidden} messages not visible")
-            break
+def track_completion(num_chunks, dl_queue, poll_interval=2, timeout=1200, max_workers=32, region=None,
+                     dead_letters_before=0):
+    """
+    Args:
+        num_chunks: number of chunks (sqs messages) in the scan
+        dl_queue: name of the dead letter queue, chunks that land here count as failed
+        poll_interval: seconds between checks
+        timeout: give up after this many seconds (default is the scan queue message retention period)
+        max_workers: number of status markers read concurrently
+        region: region of the stack the chunks were sent to, default is the configured region
+        dead_letters_before: messages on dl_queue before the scan was enqueued (check_dead_letter),
+                             the queue keeps dead letters of earlier scans for 14 days, they don't count as failed
+    Waits for every chunk to write its completion marker to status/ in the bucket (or fail)
+    :return
+        report: dict of chunks done/failed, domains scanned, domains retried in the slow lane and records found,
+                chunk_stats is a list of [domains, elapsed seconds] of every fast lane chunk
+    """
 
-        if poll_count % 2 == 0:
-            logger.info(f"{num_messages_on_que} messages left on Que, {num_messages_hidden} messages not visible")
+    context = get_context(region)
+    bucket_name = context.bucket_name
+    s3_client = context.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    logger = logging.getLogger('__main__')
 
-        time.sleep(2)
+    report = {'chunks': num_chunks, 'chunks_done': 0, 'chunks_failed': 0, 'domains': 0, 'records': 0, 'retried': 0,
+              'chunk_stats': []}
+    seen = set()
+    started = time.time()
 
-    return num_messages_success
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            new_keys = [obj['Key']
+                        for page in paginator.paginate(Bucket=bucket_name, Prefix=status_prefix)
+                        for obj in page.get('Contents', [])
+                        if obj['Key'] not in seen]
+            seen.update(new_keys)
+
+            for status in executor.map(lambda key: read_status(s3_client, bucket_name, key), new_keys):
+                report['chunks_done'] += 1
+                report['records'] += status['records']
+                # slow lane chunks retry domains that were already counted by their fast lane chunk
+                if status.get('lane') == 'slow':
+                    report['retried'] += status['domains']
+                else:
+                    report['domains'] += status['domains']
+                    report['chunk_stats'].append([status['domains'], status['elapsed']])
+                # chunks cut short by the lambda deadline re-queue their unscanned rows as a new chunk
+                report['chunks'] += status.get('spawned', 0)
+
+            report['chunks_failed'] = max(0, check_dead_letter(dl_queue, log=False, region=region)
+                                          - dead_letters_before)
+
+            if new_keys or report['chunks_failed']:
+                logger.info(f"{context.region}: {report['chunks_done']}/{report['chunks']} chunks done "
+                            f"({report['chunks_failed']} failed), "
+                            f"{report['domains']:,} domains scanned, {report['retried']:,} retried in the slow lane, "
+                            f"{report['records']:,} records found")
+
+            if report['chunks_done'] + report['chunks_failed'] >= report['chunks']:
+                break
+            if time.time() - started > timeout:
+                logger.error(f"{context.region}: timed out after {timeout}s waiting for chunks to complete")
+                break
+
+            time.sleep(poll_interval)
+
+    if report['chunks_failed'] == 0:
+        logger.info(f"{context.region}: No Dead Letters found. All Que messages successfully processed")
+    else:
+        logger.info(f"{context.region}: {report['chunks_failed']} messages failed. Check dead letter que for more info")
+
+    return report
+
+
+def merge_reports(reports):
+    """
+    Adds up the reports of track_completion in several regions
+    """
+    merged = {'chunks': 0, 'chunks_done': 0, 'chunks_failed': 0, 'domains': 0, 'records': 0, 'retried': 0,
+              'chunk_stats': []}
+    for report in reports:
+        for name in merged:
+            merged[name] += report[name]
+    return merged
+
+
+def collect_metrics(max_workers=32, regions=None):
+    """
+    Merges the metrics written by every invocation of the scan (see scan_metrics), in all regions of the scan
+    (default is the configured region)
+    :return
+        report: summary of the request timings and outcomes of the whole scan, the number of invocations,
+                and the busy and idle seconds of the multiproc workers
+    """
+    metrics = scan_metrics.new()
+    workers = {'busy': 0.0, 'idle': 0.0}
+    num_invocations = 0
+    for region in regions or [None]:
+        context = get_context(region)
+        bucket_name = context.bucket_name
+        s3_client = context.client('s3')
+        paginator = s3_client.get_paginator('list_objects_v2')
+        keys = [obj['Key']
+                for page in paginator.paginate(Bucket=bucket_name, Prefix=scan_metrics.metrics_prefix)
+                for obj in page.get('Contents', [])]
+        num_invocations += len(keys)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for invocation in executor.map(lambda key: read_status(s3_client, bucket_name, key), keys):
+                scan_metrics.merge(metrics, invocation['metrics'])
+                for name in workers:
+                    workers[name] += invocation['summary']['workers'].get(name, 0.0)
+
+    report = scan_metrics.summary(metrics)
+    report['invocations'] = num_invocations
+    total = workers['busy'] + workers['idle']
+    report['workers'] = dict(workers, utilisation=round(workers['busy'] / total, 3) if total else None)
+    return report
+
+
+def get_queue_url(queue_names: list, region=None):
+    context = get_context(region)
+    return [context.queue_url(name) for name in queue_names]
+
+
+def send_batch_with_retry(client, que_url, entries, max_retries=5, backoff=0.2):
+    """
+    Args:
+        client: boto3 sqs client
+        que_url: url of the que
+        entries: up to 10 send_message_batch entries
+        max_retries: number of times failed entries are re-sent
+        backoff: initial delay before re-sending, doubles on every retry
+    :return
+        (num_success, failed_entries): failed_entries are the response 'Failed' items that never succeeded
+    """
+
+    num_success = 0
+    sender_faults = []
+    failed = []
 
+    for attempt in range(max_retries + 1):
+        response = client.send_message_batch(QueueUrl=que_url, Entries=entries)
+        num_success += len(response.get('Successful', []))
+        failed = response.get('Failed', [])
 
-def get_queue_url(queue_names: list):
-    region = get_config()['custom']['aws_region']
-    client = boto3.client('sqs', region_name=region)
-    urls = []
+        # SenderFault means the entry itself is bad, re-sending it won't help
+        sender_faults += [entry for entry in failed if entry.get('SenderFault', False)]
+        failed = [entry for entry in failed if not entry.get('SenderFault', False)]
+        if not failed or attempt == max_retries:
+            break
 
-    for name in queue_names:
-        que_url = client.get_queue_url(QueueName=f"{name}")['QueueUrl']
-        urls.append(que_url)
+        time.sleep(backoff * (2 ** attempt))
+        retry_ids = {entry['Id'] for entry in failed}
+        entries = [entry for entry in entries if entry['Id'] in retry_ids]
 
-    return urls
+    return num_success, sender_faults + failed
 
 
-def split_and_put_into_ques(message_batch, que_urls, client, max_batch_size=10):
+def split_and_put_into_ques(message_batch, que_urls, client, max_batch_size=10, max_workers=16):
     """
     Args:
         message_batch: List of all messages to be put onto the que
         que_urls: List of que_urls for messages to be put onto
         max_batch_size: Maximum batch size (default to 10 for sqs)
         client: boto3 sqs client
+        max_workers: Number of batches sent concurrently, across all ques
     :return
         num_messages_success: Number of successful messages
     """
 
-    num_messages_success = 0
-    num_messages_failed = 0
     logger = logging.getLogger('__main__')
 
     # Split message batch into equal chunk sizes for each SQS Que
     chunks = [message_batch[i::len(que_urls)] for i in range(len(que_urls))]
     messages_per_que = zip(chunks, que_urls)
+    tally = {que_url: {'successful': 0, 'failed': 0} for que_url in que_urls}
 
-    # For each que and chunk, put onto SQS
-    for chunk, que_url in messages_per_que:
-
-        for k in range(0, len(chunk), max_batch_size):
-            response = client.send_message_batch(QueueUrl=que_url,
-                                                 Entries=chunk[k:k + max_batch_size])
-            num_messages_success += len(response.get('Successful', []))
-            num_messages_failed += len(response.get('Failed', []))
-        logger.info(f"Total Successful Messages: {len(chunk)} successful for {que_url}")
+    # Send batches to all ques at once, failed entries are retried with backoff
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for chunk, que_url in messages_per_que:
+            for k in range(0, len(chunk), max_batch_size):
+                future = executor.submit(send_batch_with_retry, client, que_url, chunk[k:k + max_batch_size])
+                futures[future] = que_url
 
+        for future in concurrent.futures.as_completed(futures):
+            que_url = futures[future]
+            num_success, failed = future.result()
+            tally[que_url]['successful'] += num_success
+            tally[que_url]['failed'] += len(failed)
+            for entry in failed:
+                logger.error(f"Failed to put message {entry['Id']} onto {que_url}: {entry.get('Message')}")
+
+    for que_url, counts in tally.items():
+        logger.info(f"{counts['successful']} successful, {counts['failed']} failed messages for {que_url}")
+
+    num_messages_success = sum(counts['successful'] for counts in tally.values())
+    num_messages_failed = sum(counts['failed'] for counts in tally.values())
     logger.info(f"Total Successful messages for all ques: {num_messages_success}")
     logger.info(f"Total failed messages for all ques: {num_messages_failed}")
 
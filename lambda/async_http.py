@@ -0,0 +1,350 @@
+import ssl
+import time
+import socket
+import asyncio
+import ipaddress
+from urllib.parse import urlsplit, urljoin
+
+# Minimal HTTP/1.1 client on top of asyncio streams.
+# The Lambda runtime only ships the standard library (plus the requests layer),
+# so this avoids pulling in aiohttp just to issue GET requests.
+
+redirect_codes = (301, 302, 303, 307, 308)
+no_body_codes = (204, 304)  # responses that never have a body (nor do 1xx, or responses to HEAD)
+max_header_size = 64 * 1024
+max_drain_size = 64 * 1024  # bodies of redirects and rejected responses up to this size are read to keep the connection
+
+ssl_context = ssl.create_default_context()
+ssl_context.check_hostname = False
+ssl_context.verify_mode = ssl.CERT_NONE  # equivalent of verify=False in requests
+
+
+class RequestException(Exception):
+    """
+    Raised for any failure to complete a request (connect, timeout, protocol errors)
+    reason is 'timeout', 'connect' (socket/DNS/TLS errors), 'rejected' or 'error' (anything else)
+    """
+
+    def __init__(self, message, reason='error'):
+        super().__init__(message)
+        self.reason = reason
+
+
+class ResponseRejected(RequestException):
+    """
+    Raised when accept_headers or accept_body rejected a response, before (all of) its body was read
+    """
+
+    def __init__(self, message):
+        super().__init__(message, reason='rejected')
+
+
+class Response:
+
+    def __init__(self, status_code, url, headers, content):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+
+async def _read_headers(reader):
+    """
+    Reads status line and headers, returns HTTP version, status_code and dict of headers (lower-cased names)
+    """
+    status_line = await reader.readline()
+    parts = status_line.decode('latin-1').split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise RequestException(f"Malformed status line {status_line[:100]!r}")
+    status_code = int(parts[1])
+
+    headers = {}
+    size = 0
+    while True:
+        line = await reader.readline()
+        size += len(line)
+        if size > max_header_size:
+            raise RequestException("Response headers too large")
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    return parts[0], status_code, headers
+
+
+def _reusable(version, headers, bodiless=False):
+    """
+    True if the connection can carry another request once this response's body has been read
+    bodiless responses (to HEAD, 1xx, 204 and 304) end with their headers, whatever their framing headers say
+    """
+    connection = headers.get('connection', '').lower()
+    framed = bodiless or 'content-length' in headers or 'chunked' in headers.get('transfer-encoding', '').lower()
+    if version == 'HTTP/1.0':
+        return framed and connection == 'keep-alive'
+    return framed and connection != 'close'
+
+
+async def _iter_body(reader, headers, block_size=64 * 1024):
+    """
+    Yields the body in blocks, based on Transfer-Encoding / Content-Length, or until connection is closed
+    """
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                # trailers (usually none) up to the empty line, so the connection is left at the next response
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            while size > 0:
+                block = await reader.readexactly(min(size, block_size))
+                size -= len(block)
+                yield block
+            await reader.readline()  # trailing \r\n after each chunk
+
+    elif 'content-length' in headers:
+        remaining = int(headers['content-length'])
+        while remaining > 0:
+            block = await reader.readexactly(min(remaining, block_size))
+            remaining -= len(block)
+            yield block
+
+    else:
+        while True:
+            block = await reader.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+async def _read_body(reader, response, max_size, sniff_size, accept_body):
+    """
+    Reads the body, stops as soon as it's larger than max_size,
+    or if accept_body returns False for its first sniff_size bytes
+    """
+    body = bytearray()
+    sniffed = accept_body is None
+    async for block in _iter_body(reader, response.headers):
+        body += block
+        if max_size is not None and len(body) > max_size:
+            raise ResponseRejected(f"Body of {response.url} larger than {max_size} bytes")
+        if not sniffed and len(body) >= sniff_size:
+            sniffed = True
+            if not accept_body(bytes(body[:sniff_size])):
+                raise ResponseRejected(f"Body of {response.url} rejected")
+
+    if not sniffed and not accept_body(bytes(body)):
+        raise ResponseRejected(f"Body of {response.url} rejected")
+    return bytes(body)
+
+
+async def _drain(reader, response):
+    """
+    Reads and discards a small body (e.g. of a redirect or a 404 page), returns False if it was too large
+    """
+    content_length = response.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > max_drain_size:
+        return False
+    try:
+        await _read_body(reader, response, max_drain_size, max_drain_size, None)
+    except ResponseRejected:
+        return False
+    return True
+
+
+def _add_timing(timings, phase, seconds):
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+async def _open(scheme, host, port, timings=None):
+    """
+    Resolves host (timed as dns) and connects to its addresses in turn (timed as connect, or tls for https)
+    """
+    started = time.perf_counter()
+    try:
+        addresses = [(None, None, None, None, (str(ipaddress.ip_address(host)), port))]
+    except ValueError:  # not an IP address, resolved on the loop's executor like asyncio.open_connection does
+        addresses = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    resolved = time.perf_counter()
+    _add_timing(timings, 'dns', resolved - started)
+
+    error = None
+    for family, type_, proto, canonname, sockaddr in addresses:
+        try:
+            connection = await asyncio.open_connection(sockaddr[0], port,
+                                                       ssl=ssl_context if scheme == 'https' else None,
+                                                       server_hostname=host if scheme == 'https' else None,
+                                                       limit=max_header_size)
+            break
+        except OSError as e:
+            error = e
+    else:
+        raise error or OSError(f"No address for {host}")
+    _add_timing(timings, 'tls' if scheme == 'https' else 'connect', time.perf_counter() - resolved)
+    return connection
+
+
+async def _request_once(session, method, url, headers, options, reuse=True):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise RequestException(f"Unsupported scheme for {url}")
+    host = parts.hostname
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    key = (parts.scheme, host, port)
+    connection = session.connections.pop(key, None) if reuse else None
+    reused = connection is not None
+    reader, writer = connection if reused else await _open(parts.scheme, host, port, options['timings'])
+    keep = False
+    try:
+        sent = time.perf_counter()
+        request_lines = [f"{method} {path} HTTP/1.1",
+                         f"Host: {parts.netloc}",
+                         "Accept-Encoding: identity",
+                         "Connection: keep-alive" if session.keep_alive else "Connection: close"]
+        request_lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(('\r\n'.join(request_lines) + '\r\n\r\n').encode('latin-1'))
+        try:
+            await writer.drain()
+            version, status_code, response_headers = await _read_headers(reader)
+        except (OSError, RequestException):
+            if not reused:
+                raise
+            # the server closed the idle connection, retry once on a new one
+            return await _request_once(session, method, url, headers, options, reuse=False)
+        _add_timing(options['timings'], 'ttfb', time.perf_counter() - sent)
+
+        response = Response(status_code, url, response_headers, None)
+        bodiless = method == 'HEAD' or status_code in no_body_codes or status_code < 200
+        reusable = session.keep_alive and _reusable(version, response_headers, bodiless)
+
+        if bodiless:
+            response.content = b''
+            keep = reusable
+            return response
+        if status_code in redirect_codes and 'location' in response_headers:
+            keep = reusable and await _drain(reader, response)
+            return response
+
+        content_length = response_headers.get('content-length', '')
+        if options['max_size'] is not None and content_length.isdigit() and int(content_length) > options['max_size']:
+            raise ResponseRejected(f"Content-Length of {url} larger than {options['max_size']} bytes")
+        if options['accept_headers'] is not None and not options['accept_headers'](response):
+            keep = reusable and await _drain(reader, response)
+            raise ResponseRejected(f"Headers of {url} rejected")
+
+        receiving = time.perf_counter()
+        response.content = await _read_body(reader, response, options['max_size'],
+                                            options['sniff_size'], options['accept_body'])
+        _add_timing(options['timings'], 'body', time.perf_counter() - receiving)
+        keep = reusable
+    finally:
+        # responses cut short leave unread data behind, their connection is closed
+        if keep:
+            session.connections[key] = (reader, writer)
+        else:
+            writer.close()
+
+    return response
+
+
+async def _request(session, method, url, headers, max_redirects, options):
+    for _ in range(max_redirects + 1):
+        response = await _request_once(session, method, url, headers, options)
+        if response.status_code in redirect_codes and 'location' in response.headers:
+            url = urljoin(url, response.headers['location'])
+        else:
+            return response
+
+    raise RequestException(f"Exceeded {max_redirects} redirects")
+
+
+class Session:
+    """
+    Keeps one idle connection per (scheme, host, port) open between requests, so several requests to the
+    same host share the TCP (and TLS) handshake. Not for concurrent requests to the same host.
+    Must be closed after use.
+
+    usage:
+        session = Session()
+        try:
+            response = await session.request('GET', url)
+        finally:
+            session.close()
+    """
+
+    def __init__(self, keep_alive=True):
+        self.keep_alive = keep_alive
+        self.connections = {}
+
+    async def request(self, method, url, headers=None, timeout=1.5, max_redirects=30,
+                      max_size=None, accept_headers=None, accept_body=None, sniff_size=4096, timings=None):
+        """
+        Args:
+            method: 'GET' or 'HEAD' (responses to HEAD, 204 and 304 responses have empty content
+                    and are returned without calling accept_headers)
+            url: url to request, redirects are followed
+            headers: dict of additional request headers
+            timeout: total time allowed for the request (including redirects)
+            max_redirects: maximum number of redirects to follow (default matches requests)
+            max_size: stop reading and reject the response once the body is larger than this
+                      (or Content-Length says so)
+            accept_headers: optional callable, receives the final Response before its body is read
+                            (content is None), returns False to reject it without reading the body
+            accept_body: optional callable, receives the first sniff_size bytes of the body,
+                         returns False to reject the response without reading the rest
+            timings: optional dict, seconds spent in each phase are added to it: dns, connect (or tls for https),
+                     ttfb (request sent until headers read) and body. Phases of redirects are added up
+        :return
+            Response object, response.url is the final url after redirects
+        :raises
+            RequestException, or its subclass ResponseRejected if the response was rejected
+        """
+        options = {'max_size': max_size,
+                   'accept_headers': accept_headers,
+                   'accept_body': accept_body,
+                   'sniff_size': sniff_size,
+                   'timings': timings}
+        try:
+            return await asyncio.wait_for(_request(self, method, url, headers or {}, max_redirects, options),
+                                          timeout=timeout)
+        except RequestException:
+            raise
+        except asyncio.TimeoutError as e:
+            raise RequestException(f"{type(e).__name__} for {url}", reason='timeout') from e
+        except OSError as e:
+            raise RequestException(f"{type(e).__name__} for {url}", reason='connect') from e
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, UnicodeError) as e:
+            raise RequestException(f"{type(e).__name__} for {url}") from e
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    def close(self):
+        for reader, writer in self.connections.values():
+            writer.close()
+        self.connections = {}
+
+
+async def get(url, headers=None, timeout=1.5, max_redirects=30,
+              max_size=None, accept_headers=None, accept_body=None, sniff_size=4096):
+    """
+    Single GET request on a new connection, see Session.request for the arguments
+    """
+    session = Session(keep_alive=False)
+    try:
+        return await session.request('GET', url, headers=headers, timeout=timeout, max_redirects=max_redirects,
+                                     max_size=max_size, accept_headers=accept_headers, accept_body=accept_body,
+                                     sniff_size=sniff_size)
+    finally:
+        session.close()
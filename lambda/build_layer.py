@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import array
+import zipfile
+import argparse
+import urllib.request
+
+# Builds layers/majestic_million.csv.zip, the artifact of the majestic layer in serverless.yml
+# The layer contains the csv file and a row index, both are extracted into /opt in the lambda
+# The index is an array of unsigned 64-bit little endian byte offsets, one per row plus the file size,
+# so that row n of the csv spans bytes index[n] to index[n+1]
+
+majestic_url = 'http://downloads.majestic.com/majestic_million.csv'
+layer_dir = 'layers'
+csv_name = 'majestic_million.csv'
+index_suffix = '.idx'
+
+
+def build_index(csv_file):
+    """
+    Reads csv_file once and returns an array of byte offsets of every row (and the end of file)
+    """
+    offsets = array.array('Q')
+    if offsets.itemsize != 8:
+        raise RuntimeError("Platform does not have a 64-bit unsigned array type")
+
+    position = 0
+    with open(csv_file, 'rb') as f:
+        for line in f:
+            offsets.append(position)
+            position += len(line)
+    offsets.append(position)
+
+    return offsets
+
+
+def write_index(csv_file):
+    """
+    Writes the index of csv_file next to it (csv_file + index_suffix), returns the number of rows
+    """
+    offsets = build_index(csv_file)
+    with open(csv_file + index_suffix, 'wb') as f:
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        offsets.tofile(f)
+    return len(offsets) - 1
+
+
+def build_layer(csv_file, zip_file):
+    index_file = csv_file + index_suffix
+
+    num_rows = write_index(csv_file)
+    print(f"Indexed {num_rows:,} rows of {csv_file} into {index_file}")
+
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        z.write(csv_file, arcname=csv_name)
+        z.write(index_file, arcname=csv_name + index_suffix)
+    print(f"Layer written to {zip_file}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--download",
+                        help="Download a fresh copy of the majestic million before building",
+                        action='store_true')
+    args = parser.parse_args()
+
+    os.makedirs(layer_dir, exist_ok=True)
+    csv_path = os.path.join(layer_dir, csv_name)
+
+    if args.download or not os.path.exists(csv_path):
+        print(f"Downloading {majestic_url}")
+        urllib.request.urlretrieve(majestic_url, csv_path)
+
+    build_layer(csv_path, os.path.join(layer_dir, csv_name + '.zip'))
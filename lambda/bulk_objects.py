@@ -0,0 +1,77 @@
+import os
+import logging
+import concurrent.futures
+
+# Listing, deleting and downloading many objects of a bucket with a pool of threads.
+# Used by the clear_bucket function and by the driver (invocations loads it from here), standard library only.
+
+
+def iter_pages(client, bucket_name, prefix=''):
+    """
+    Yields lists of keys in the bucket, one list per list_objects_v2 page (up to 1000 keys)
+    """
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        keys = [obj['Key'] for obj in page.get('Contents', [])]
+        if keys:
+            yield keys
+
+
+def _delete_keys(client, bucket_name, keys):
+    response = client.delete_objects(Bucket=bucket_name,
+                                     Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    return len(keys) - len(response.get('Errors', [])), response.get('Errors', [])
+
+
+def delete_objects(client, bucket_name, prefix='', max_workers=16):
+    """
+    Args:
+        client: boto3 s3 client
+        bucket_name: bucket to delete from
+        prefix: only delete keys starting with prefix (e.g. 'robots/'), default is everything
+        max_workers: number of delete_objects calls in flight
+    Deletes are submitted as each page is listed, so listing and deleting overlap
+    :return
+        num_deleted: number of objects deleted
+    """
+    logger = logging.getLogger('__main__')
+    num_deleted = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_delete_keys, client, bucket_name, keys)
+                   for keys in iter_pages(client, bucket_name, prefix)]
+
+        for future in concurrent.futures.as_completed(futures):
+            deleted, errors = future.result()
+            num_deleted += deleted
+            for error in errors:
+                logger.error(f"Failed to delete {error['Key']}: {error['Message']}")
+
+    return num_deleted
+
+
+def _download_key(client, bucket_name, key, folder):
+    file_name = os.path.join(folder, key)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    client.download_file(bucket_name, key, file_name)
+    return file_name
+
+
+def download_objects(client, bucket_name, folder, prefix='', max_workers=32):
+    """
+    Args:
+        client: boto3 s3 client
+        bucket_name: bucket to download from
+        folder: local folder, keys are downloaded into folder/<key>
+        prefix: only download keys starting with prefix (e.g. 'robots/'), default is everything
+        max_workers: number of downloads in flight
+    Downloads are submitted as each page is listed, so listing and downloading overlap
+    :return
+        file_names: list of local files downloaded
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_download_key, client, bucket_name, key, folder)
+                   for keys in iter_pages(client, bucket_name, prefix)
+                   for key in keys]
+
+        return [future.result() for future in concurrent.futures.as_completed(futures)]
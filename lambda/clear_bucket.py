@@ -1,38 +1,30 @@
 import boto3
+import botocore.config
 import os
 import logging
 
+import bulk_objects
+
 logger = logging.getLogger()
 level = logging.INFO
 logger.setLevel(level)
 
+max_workers = 16
+
 
-def clear_bucket(event,context):
+def clear_bucket(event, context):
     """
-    compresses all files in an s3_bucket to a zip file
+    deletes all files in the s3_bucket, or only those under event['prefix'] (e.g. 'robots/')
+    each page of 1000 keys is deleted by a pool of threads while the next page is listed
     """
     logger.info('__start__')
-    s3_client = boto3.client('s3')
-
-    kwargs = {'Bucket': os.environ['bucket_name']}
-
-    while True:
-        resp = s3_client.list_objects_v2(**kwargs)
-        keys = []
-
-        for obj in resp.get('Contents', []):
-            keys.append({'Key': obj['Key']})
+    s3_client = boto3.client('s3', config=botocore.config.Config(max_pool_connections=max_workers))
+    bucket_name = os.environ['bucket_name']
+    prefix = (event or {}).get('prefix', '')
 
-        if len(keys) > 0:
-            s3_client.delete_objects(Bucket=os.environ['bucket_name'],
-                                     Delete={'Objects': keys})
-        else:
-            print("Bucket is empty.")
+    num_deleted = bulk_objects.delete_objects(s3_client, bucket_name, prefix=prefix, max_workers=max_workers)
 
-        # try the next iteration, (list_objects_v2 only returns first 1000 entries)
-        try:
-            kwargs['ContinuationToken'] = resp['NextContinuationToken']
-        except KeyError:
-            break
+    if num_deleted == 0:
+        print("Bucket is empty.")
     logger.info('__end__')
-    return keys
+    return num_deleted
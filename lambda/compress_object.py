@@ -1,41 +1,60 @@
 import boto3
 import os
 import gzip
-import tempfile
 import logging
 import datetime
+import collections
+import concurrent.futures
+
+import result_stream
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+block_size = 16 * 1024 * 1024
+
+
+def gzip_block(block):
+    # every block becomes a complete gzip member, concatenated members are still a valid gzip file
+    return gzip.compress(block, compresslevel=6)
+
+
+def compress_stream(chunks, compress, output, max_workers):
+    """
+    Compresses each chunk from chunks on a pool of threads (zlib releases the GIL)
+    and writes the compressed blocks to output in their original order.
+    At most 2 * max_workers blocks are held in memory at any time.
+    """
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(compress, chunk))
+            if len(pending) >= 2 * max_workers:
+                output.write(pending.popleft().result())
+        while pending:
+            output.write(pending.popleft().result())
+
 
 def main(event, context):
     """
     Converts a single file in event['filename'] to gzip compressed into the same bucket
     gzip is placed into the 'root' directory of the bucket, with the form 'filename'.gz
+
+    The file is streamed: downloaded in blocks, each block compressed in parallel across the
+    lambda's vCPUs, and uploaded as a multipart upload, so the full object is never held in memory or /tmp.
     """
     logger.info(event)
 
     file_name = event['result_file']
-    gz_file = f'{file_name.split("/")[-1]}.gz'
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(os.environ['bucket_name'])
-
-    tmp = tempfile.SpooledTemporaryFile(mode='w+b')
-    logger.info(f'Downloading result file {file_name}')
-    with tmp as fileobj:
-        bucket.download_fileobj(file_name, fileobj)
-        fileobj.seek(0)  # reset stream to beginning of file
-        logger.info('Compressing Downloaded File')
-        with gzip.open(f'/tmp/{gz_file}', 'wb') as compressed_file:
-            compressed_file.write(fileobj.read())
-            logger.info('File Compressed, uploading to S3')
-
+    bucket_name = os.environ['bucket_name']
+    s3_client = boto3.client('s3')
     today = datetime.datetime.today()
     output_file = f"robots_{today.year}-{today.month:02}-{today.day:02}.csv.gz"
-    s3.Bucket(os.environ['bucket_name']).upload_file(f'/tmp/{gz_file}', output_file)
-    os.remove(f'/tmp/{gz_file}')
-    logger.info(f'File Uploaded {gz_file} into {bucket}')
 
-    return f's3://{os.environ["bucket_name"]}/{output_file}'
+    logger.info(f'Compressing result file {file_name} into {output_file}')
+    body = s3_client.get_object(Bucket=bucket_name, Key=file_name)['Body']
+    with result_stream.MultipartUpload(s3_client, bucket_name, output_file, part_size=block_size) as upload:
+        compress_stream(body.iter_chunks(block_size), gzip_block, upload, max_workers=os.cpu_count() or 2)
+    logger.info(f'File Uploaded {output_file} into {bucket_name}')
+
+    return f's3://{bucket_name}/{output_file}'
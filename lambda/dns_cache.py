@@ -0,0 +1,129 @@
+import time
+import socket
+import logging
+import concurrent.futures
+
+import scan_metrics
+
+# Caching resolver for the lifetime of the lambda container.
+# requests (urllib3) and asyncio both resolve through socket.getaddrinfo, so once install() is called
+# every lookup, including those of redirects, is answered from here. Names that don't exist are cached too,
+# and can be skipped without opening a socket (see unresolvable).
+# getaddrinfo doesn't expose the record's TTL, so entries expire after a fixed time instead.
+
+logger = logging.getLogger('main_logger')
+
+positive_ttl = 300
+negative_ttl = 60
+nxdomain_errors = tuple(getattr(socket, name) for name in ('EAI_NONAME', 'EAI_NODATA') if hasattr(socket, name))
+
+_getaddrinfo = socket.getaddrinfo  # the real resolver
+cache = {}  # host: (expires, list of getaddrinfo results with port 0, or the socket.gaierror raised)
+
+
+def hostname(host):
+    """
+    Name to resolve for a domain, without the port of a host:port
+    """
+    name, colon, port = host.rpartition(':')
+    return name if colon and port.isdigit() and ':' not in name else host
+
+
+def _lookup(host):
+    entry = cache.get(host)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+
+    try:
+        result = _getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        cache[host] = (time.time() + positive_ttl, result)
+    except socket.gaierror as e:
+        if e.errno not in nxdomain_errors:
+            raise  # temporary failures (e.g. EAI_AGAIN) are not cached
+        result = e
+        cache[host] = (time.time() + negative_ttl, result)
+    return result
+
+
+def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """
+    Drop-in replacement for socket.getaddrinfo, TCP lookups of host names are answered from the cache
+    """
+    if (host is None or flags or type not in (0, socket.SOCK_STREAM) or proto not in (0, socket.IPPROTO_TCP)
+            or not (port is None or isinstance(port, int) or str(port).isdigit())):
+        return _getaddrinfo(host, port, family, type, proto, flags)
+
+    result = _lookup(host.decode('idna') if isinstance(host, bytes) else host)
+    if isinstance(result, socket.gaierror):
+        raise socket.gaierror(result.errno, result.strerror)
+
+    port = int(port or 0)
+    return [(addr_family, addr_type, addr_proto, canonname, (sockaddr[0], port) + sockaddr[2:])
+            for addr_family, addr_type, addr_proto, canonname, sockaddr in result
+            if family in (0, addr_family)]
+
+
+def install():
+    """
+    Replaces socket.getaddrinfo with the caching version for this process (and processes forked from it)
+    """
+    socket.getaddrinfo = getaddrinfo
+
+
+def unresolvable(host):
+    """
+    True if host is cached as not existing, False if it resolved or hasn't been looked up
+    """
+    entry = cache.get(hostname(host))
+    return entry is not None and entry[0] > time.time() and isinstance(entry[1], socket.gaierror)
+
+
+def entries(hosts):
+    """
+    Cache entries of hosts, to be added to another process's cache with update
+    """
+    names = {hostname(host) for host in hosts}
+    return {name: cache[name] for name in names if name in cache}
+
+
+def update(host_entries):
+    cache.update(host_entries)
+
+
+def prefetch(hosts, max_workers=64, deadline=None):
+    """
+    Resolves hosts concurrently into the cache, before they are requested
+    stops waiting at deadline (a time.time()), hosts not resolved by then are looked up when they're requested
+    (lookups already running finish in the background, getaddrinfo can't be interrupted)
+    returns the number of hosts that don't exist, the time of every lookup is added to scan_metrics as prefetch
+    """
+    now = time.time()
+    for host in [host for host, (expires, result) in cache.items() if expires <= now]:
+        cache.pop(host, None)
+
+    def resolve(host):
+        looking_up = time.perf_counter()
+        try:
+            missing = isinstance(_lookup(host), socket.gaierror)
+        except (socket.gaierror, UnicodeError):
+            missing = False
+        return missing, time.perf_counter() - looking_up
+
+    hosts = {hostname(host) for host in hosts}
+    started = time.time()
+    nxdomain = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = [executor.submit(resolve, host) for host in hosts]
+    done, not_done = concurrent.futures.wait(futures, timeout=None if deadline is None else max(0, deadline - started))
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=False)
+    for future in done:
+        missing, seconds = future.result()
+        nxdomain += missing
+        scan_metrics.observe('prefetch', seconds)
+
+    logger.info("Resolved {} hosts in {:.2f}s, {} don't exist".format(len(done), time.time() - started, nxdomain))
+    if not_done:
+        logger.warning("Stopped prefetching at the deadline, {} hosts left to resolve".format(len(not_done)))
+    return nxdomain
@@ -1,14 +1,22 @@
 import logging
-import io
 import json
 import os
+import time
+import functools
 import boto3
 import urllib3
 import requests
+import probes
+import async_http
+import dns_cache
+import scan_state
+import scan_metrics
+import result_stream
 import lambda_multiproc
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+dns_cache.install()  # requests and asyncio resolve through the cache, see dns_cache
 
 # There must be a logger called main_logger
 logger = logging.getLogger('main_logger')
@@ -16,82 +24,610 @@ level = logging.INFO
 logger.setLevel(level)
 
 headers = {'User-Agent': 'p40Bot'}
+s3_prefix = 'robots/'
+bodies_prefix = 'bodies/'
+status_prefix = 'status/'
+failures_prefix = 'failures/'
+deadline_margin = 5  # seconds kept in reserve to upload results and re-queue unscanned rows
+retry_reasons = ('timeout', 'connect')  # failures retried in the slow lane
+slow_timeout = 5  # defaults for the slow lane, overridden by the scan's slow_timeout/slow_concurrency
+slow_concurrency = 800
+max_message_size = 240 * 1024  # slow lane messages carry their rows, kept under SQS's limit of 256KB
+block_size = 64 * 1024
+session = None  # one session per worker process, created on first use and kept with the worker (see WorkerPool)
+state = {}  # previous scan's state of the batch's hosts in incremental scans, see scan_state
 
 
-def request(rows, conn):
+def row_host(row):
+    # domain name from row of majestic top 1 million
+    return row.split(',')[2].strip()
+
+
+def setup_worker(batch_state, dns_entries):
+    """
+    Runs in each multiproc worker before it scans the batch, the workers are kept between invocations
+    """
+    global state
+    state = batch_state
+    dns_cache.update(dns_entries)
+
+
+def prepare_batch(rows, deadline=None):
+    """
+    Resolves the hosts of all rows of the batch concurrently before scanning,
+    for at most half the time left before the scan's deadline, so slow resolvers can't take up the whole scan
+    returns the setup for the multiproc workers: the resolved hosts and the batch's state
+    """
+    hosts = [row_host(row) for row in rows]
+    now = time.time()
+    dns_cache.prefetch(hosts, deadline=None if deadline is None else now + (deadline - now) / 2)
+    return functools.partial(setup_worker, state, dns_cache.entries(hosts))
+
+
+def get_session():
+    global session
+    if session is None:
+        session = requests.session()
+        session.headers.update(headers)
+    return session
+
+
+def read_streamed(response, probe):
+    """
+    Reads the body of a streamed requests response, the same way async_http does:
+    returns None as soon as it is larger than probe.max_size or its first bytes are rejected by the probe
+    """
+    content_length = response.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > probe.max_size:
+        return None
+
+    body = bytearray()
+    sniffed = False
+    for block in response.iter_content(block_size):
+        body += block
+        if len(body) > probe.max_size:
+            return None
+        if not sniffed and len(body) >= probes.sniff_size:
+            sniffed = True
+            if not probes.accept_body(probe, bytes(body[:probes.sniff_size])):
+                return None
+
+    if not sniffed and not probes.accept_body(probe, bytes(body)):
+        return None
+    return bytes(body)
+
+
+def conditional_headers(host, probe):
+    """
+    If-None-Match / If-Modified-Since for a probe, from the state of host in the previous scan
+    """
+    etag, last_modified, content_hash = state.get(host, {}).get(probe.name, (None, None, None))
+    conditional = {}
+    if etag:
+        conditional['If-None-Match'] = etag
+    if last_modified:
+        conditional['If-Modified-Since'] = last_modified
+    return conditional
+
+
+def probe_value(host, probe, response, content, found=None):
+    """
+    Returns the value of a probe's column, or None if the probe found nothing
+
+    In incremental scans (found is a dict of 'state' and 'bodies') the value of a GET probe is the hash of its body.
+    The new state of the probe is added to found['state'], and the body to found['bodies'] if it changed since
+    the previous scan (unchanged bodies were stored by an earlier scan). A 304 keeps the previous hash.
+    """
+    if found is None or probe.method == 'HEAD':
+        return probes.value(probe, response, content)
+
+    previous = state.get(host, {}).get(probe.name)
+    if response.status_code == 304:
+        if previous is None:
+            return None
+        entry = [response.headers.get('etag') or previous[0],
+                 response.headers.get('last-modified') or previous[1],
+                 previous[2]]
+    else:
+        text = probes.value(probe, response, content)
+        if text is None:
+            return None
+        entry = [response.headers.get('etag'), response.headers.get('last-modified'), scan_state.body_hash(content)]
+        if previous is None or previous[2] != entry[2]:
+            found['bodies'][entry[2]] = text
+
+    found['state'][probe.name] = entry
+    return entry[2]
+
+
+def record(host, selected, values, found=None):
+    """
+    Result record of a host, None if none of the probes found anything
+    In incremental scans the record also carries the host's new state and changed bodies (see probe_value),
+    ChunkOutput splits those off into their own files
+    """
+    if all(values.get(probe.name) is None for probe in selected):
+        return None
+    # domain keeps the robots.txt url it has always held, so results of earlier scans stay comparable
+    result = {'domain': 'http://{}/robots.txt'.format(host)}
+    result.update((probe.name, values.get(probe.name)) for probe in selected)
+    if found is not None:
+        result['_state'] = {'host': host, 'probes': found['state']}
+        result['_bodies'] = found['bodies']
+    return result
+
+
+def fetch(s, probe, host, timeout, found=None, timings=None):
+    """
+    Makes a probe's request with the requests session
+    returns the probe's value (or None), the outcome (see scan_metrics) and the number of bytes of the body
+
+    ttfb and body timings are added to timings. requests doesn't expose its connection, so ttfb includes
+    resolving and connecting (response.elapsed, the time until the headers were read)
+    """
+    timings = {} if timings is None else timings
+    url = 'http://{}{}'.format(host, probe.path)
+    if probe.method == 'HEAD':
+        response = s.head(url, verify=False, timeout=timeout, allow_redirects=True)
+        timings['ttfb'] = response.elapsed.total_seconds()
+        return probes.value(probe, response, b''), 'found', 0
+
+    # stream, so that the body is only downloaded if the headers look right, and no more than max_size
+    with s.get(url, verify=False, timeout=timeout, stream=True,
+               headers=conditional_headers(host, probe) if found is not None else None) as response:
+        timings['ttfb'] = response.elapsed.total_seconds()
+        if response.status_code == 304:
+            content = b''
+        elif probes.accept_headers(probe, response):
+            receiving = time.perf_counter()
+            content = read_streamed(response, probe)
+            timings['body'] = time.perf_counter() - receiving
+        else:
+            content = None
+    if content is None:
+        return None, 'rejected', 0
+
+    value = probe_value(host, probe, response, content, found)
+    if response.status_code == 304:
+        return value, 'not_modified', 0
+    return value, 'found' if value is not None else 'not_found', len(content)
+
+
+def observe_request(outcome, timings, started, num_bytes=0):
+    """
+    Adds a probe's request to this process's metrics, see scan_metrics
+    """
+    for phase, seconds in timings.items():
+        scan_metrics.observe(phase, seconds)
+    scan_metrics.observe('total', time.perf_counter() - started)
+    scan_metrics.outcome(outcome, num_bytes)
+
+
+def request(rows, timeout=1.5, probe_names=None, incremental=False):
 
     """
     Receives a list of text to be processed, one element per row
-    Returns a list of dictionaries to be combined into a single file
+    Returns a list of dictionaries to be combined into a single file,
+    plus a result_stream.Failure for every row that timed out or failed to connect
+
+    Every probe in probe_names is requested from each domain, over the session's pooled connection
+    In incremental scans, requests are conditional on the previous scan's state
+    Timings and outcomes of the requests are added to this process's scan_metrics
     """
-    s = requests.session()
-    s.headers.update(headers)
+    s = get_session()
+    selected = probes.get_probes(probe_names)
     responses = []
 
     for row in rows:
-        # get domain name from row of majestic top 1 million
-        url = 'http://{}/robots.txt'.format(row.split(',')[2].strip())
+        host = row_host(row)
+        if dns_cache.unresolvable(host):
+            scan_metrics.outcome('nxdomain')
+            continue  # domain doesn't exist, no need to open a socket
+
+        values = {}
+        found = {'state': {}, 'bodies': {}} if incremental else None
+        failure = None
+        for index, probe in enumerate(selected):
+            url = 'http://{}{}'.format(host, probe.path)
+            reason = None
+            outcome, num_bytes, timings, started = 'error', 0, {}, time.perf_counter()
+            try:
+                values[probe.name], outcome, num_bytes = fetch(s, probe, host, timeout, found, timings)
+            except requests.exceptions.Timeout:
+                logger.error(f"Request Exception for {url}")
+                reason = outcome = 'timeout'
+            except requests.exceptions.ConnectionError:
+                logger.error(f"Request Exception for {url}")
+                reason = outcome = 'connect'
+            except requests.exceptions.RequestException:
+                logger.error(f"Request Exception for {url}")
+            except UnicodeError:  # sometimes occur with websites
+                pass
+            except urllib3.exceptions.HeaderParsingError:
+                logger.error(f"Failed Header parsing for {url}")
+            observe_request(outcome, timings, started, num_bytes)
+
+            if reason is not None and index == 0:
+                failure = result_stream.Failure(row, reason)
+                break  # the host didn't answer the first probe, the whole row is retried
+
+        if failure is not None:
+            responses.append(failure)
+        else:
+            result = record(host, selected, values, found)
+            if result is not None:
+                responses.append(result)
+
+    return responses
+
+
+async def async_request(row, timeout, probe_names=None, incremental=False):
 
+    """
+    Receives a single row to be processed, the asyncio counterpart of request
+    Returns a dictionary to be combined into a single file, or None if none of the probes found anything,
+    or a result_stream.Failure if the first probe timed out or failed to connect
+
+    The probes are made one after another, over one keep-alive connection per host
+    In incremental scans, requests are conditional on the previous scan's state
+    Timings and outcomes of the requests are added to this process's scan_metrics
+    """
+    host = row_host(row)
+    if dns_cache.unresolvable(host):
+        scan_metrics.outcome('nxdomain')
+        return None  # domain doesn't exist, no need to open a socket
+
+    selected = probes.get_probes(probe_names)
+    values = {}
+    found = {'state': {}, 'bodies': {}} if incremental else None
+    session = async_http.Session()
+    try:
+        for index, probe in enumerate(selected):
+            url = 'http://{}{}'.format(host, probe.path)
+            request_headers = dict(headers, **conditional_headers(host, probe)) if incremental else headers
+            timings, started = {}, time.perf_counter()
+            try:
+                response = await session.request(probe.method, url, headers=request_headers, timeout=timeout,
+                                                 max_size=probe.max_size,
+                                                 accept_headers=functools.partial(probes.accept_headers, probe),
+                                                 accept_body=functools.partial(probes.accept_body, probe),
+                                                 sniff_size=probes.sniff_size,
+                                                 timings=timings)
+                values[probe.name] = probe_value(host, probe, response, response.content, found)
+                if response.status_code == 304:
+                    outcome = 'not_modified'
+                else:
+                    outcome = 'not_found' if values[probe.name] is None else 'found'
+                observe_request(outcome, timings, started, len(response.content))
+            except async_http.ResponseRejected as e:
+                logger.debug(str(e))  # nothing to find here, no need to read further
+                observe_request('rejected', timings, started)
+            except async_http.RequestException as e:
+                logger.error(f"Request Exception for {url}")
+                observe_request(e.reason, timings, started)
+                if index == 0 and e.reason in retry_reasons:
+                    return result_stream.Failure(row, e.reason)
+    finally:
+        session.close()
+
+    return record(host, selected, values, found)
+
+
+def requeue(sqs_client, queue_arn, message):
+    """
+    Puts message back onto the queue it came from (identified by the record's eventSourceARN)
+    """
+    region, account, queue_name = queue_arn.split(':')[3:6]
+    que_url = sqs_client.get_queue_url(QueueName=queue_name, QueueOwnerAWSAccountId=account)['QueueUrl']
+    sqs_client.send_message(QueueUrl=que_url, MessageBody=json.dumps(message))
+
+
+class ChunkOutput:
+    """
+    Result file and completion marker of one chunk (one SQS message) of the scan
+
+    Results are streamed into the bucket as they arrive, rather than collected in memory.
+    If writing fails the chunk is marked as failed, and the rest of the batch carries on.
+
+    Chunks in the slow lane carry their own rows (domains that timed out or failed to connect in a
+    fast lane chunk), start_pos and end_pos index into those rows.
+
+    In incremental scans, the result records hold content hashes, the bodies are written to a second file
+    (under bodies/, each hash once per chunk) and the hosts' new state to a state file (see scan_state).
+    """
+
+    def __init__(self, s3_client, message, queue_arn, started):
+        self.s3_client = s3_client
+        self.message = message
+        self.queue_arn = queue_arn
+        self.started = started
+        self.failed = False
+        self.lane = message.get('lane', 'fast')
+
+        # output_format is one of 'jsonl', 'jsonl.gz' or 'parquet', under a scan_date=YYYY-MM-DD partition
+        output_format = message.get('output_format', 'jsonl')
+        scan_date = message.get('scan_date', time.strftime('%Y-%m-%d', time.gmtime()))
+        self.file_name = "{}-{}".format(message['start_pos'], message['end_pos'])
+        if self.lane == 'slow':
+            self.file_name = "{}.slow.{}".format(message['chunk'], self.file_name)
+        key = result_stream.output_key(s3_prefix, scan_date, self.file_name, output_format)
+        self.upload = result_stream.MultipartUpload(s3_client, os.environ['bucket_name'], key)
+        columns = probes.columns(message.get('probes'))
+        self.writer = result_stream.format_writer(self.upload, output_format, columns)
+
+        self.incremental = message.get('incremental', False)
+        self.scan_date = scan_date
+        self.state = {}
+        self.stored = set()  # hashes of the bodies written by this chunk
+        if self.incremental:
+            key = result_stream.output_key(bodies_prefix, scan_date, self.file_name, output_format)
+            self.bodies_upload = result_stream.MultipartUpload(s3_client, os.environ['bucket_name'], key)
+            self.bodies_writer = result_stream.format_writer(self.bodies_upload, output_format, ['hash', 'body'])
+
+    def split_incremental(self, data):
+        """
+        Splits the state and bodies off the records of an incremental scan (see record),
+        writes the bodies not yet written by this chunk, and returns the records to write
+        """
+        records = []
+        bodies = []
+        for line in data.splitlines():
+            result = json.loads(line)
+            host_state = result.pop('_state')
+            self.state[host_state['host']] = host_state['probes']
+            for content_hash, body in result.pop('_bodies').items():
+                if content_hash not in self.stored:
+                    self.stored.add(content_hash)
+                    bodies.append({'hash': content_hash, 'body': body})
+            records.append(result)
+        if bodies:
+            self.bodies_writer.write(result_stream.encode_jsonl(bodies))
+        return result_stream.encode_jsonl(records)
+
+    def write(self, data):
+        if self.failed:
+            return
         try:
-            response = s.get(url,
-                             verify=False,
-                             timeout=1.5)
-            if response.status_code == 200 and response.url[-10:] == 'robots.txt':
-                if 'user-agent:' in response.text.lower():
-                    if len(response.content) < 1024 * 1024:
-                        try:
-                            responses.append({'domain': url,
-                                              'robots.txt': response.content.decode('utf-8')})
-                        except UnicodeDecodeError:
-                            logger.error(f"Robots.txt for {url} is not properly encoded")
-                    else:
-                        logger.error(f"Robots.txt for {url} is larger than 1 MB")
-
-        except requests.exceptions.RequestException:
-            logger.error(f"Request Exception for {url}")
-        except UnicodeError:  # sometimes occur with websites
-            pass
-        except urllib3.exceptions.HeaderParsingError:
-            logger.error(f"Failed Header parsing for {url}")
-
-    conn.send(responses)
-    conn.close()
+            if self.incremental:
+                data = self.split_incremental(data)
+            self.writer.write(data)
+        except Exception as e:
+            logger.error(f"Failed writing results of {self.file_name}: {type(e).__name__} {e}")
+            self.failed = True
+
+    def write_failures(self, failures):
+        """
+        Writes the domains that timed out or failed to connect as a side output, grouped by reason
+        """
+        side_output = {'chunk': self.file_name, 'lane': self.lane}
+        for failure in failures:
+            side_output.setdefault(failure.reason, []).append(row_host(failure.row))
+        self.s3_client.put_object(Bucket=os.environ['bucket_name'],
+                                  Key=failures_prefix + "{}.json".format(self.file_name),
+                                  Body=json.dumps(side_output).encode('utf-8'))
+
+    def schedule_slow_lane(self, sqs_client, failures):
+        """
+        Sends the rows that timed out or failed to connect to the slow lane queue,
+        to be retried with a longer timeout. The rows are split into as many chunks as needed to keep every
+        message under max_message_size. Returns the number of chunks scheduled
+        """
+        if self.lane == 'slow' or not failures or not os.environ.get('slow_queue'):
+            return 0
+        if self.message.get('slow_timeout', slow_timeout) <= 0:  # slow lane disabled for this scan
+            return 0
+
+        base_size = len(json.dumps(self.message)) + 256  # room for the slow lane's own keys
+        parts = [[]]
+        size = base_size
+        for failure in failures:
+            row_size = len(json.dumps(failure.row)) + 2
+            if parts[-1] and size + row_size > max_message_size:
+                parts.append([])
+                size = base_size
+            parts[-1].append(failure.row)
+            size += row_size
+
+        scheduled = 0
+        for index, rows in enumerate(parts):
+            slow_message = dict(self.message,
+                                lane='slow',
+                                # every part of a chunk needs its own file name
+                                chunk=self.file_name if len(parts) == 1 else "{}.{}".format(self.file_name, index),
+                                rows=rows,
+                                start_pos=0,
+                                end_pos=len(rows),
+                                timeout=self.message.get('slow_timeout', slow_timeout),
+                                concurrency=self.message.get('slow_concurrency', slow_concurrency))
+            try:
+                sqs_client.send_message(QueueUrl=os.environ['slow_queue'], MessageBody=json.dumps(slow_message))
+                scheduled += 1
+            except Exception as e:
+                logger.error(f"Failed scheduling {len(rows)} rows of {self.file_name} for the slow lane: "
+                             f"{type(e).__name__} {e}")
+        logger.info("Scheduled {} rows of {} for the slow lane in {} chunks".format(
+            sum(len(rows) for rows in parts), self.file_name, scheduled))
+        return scheduled
+
+    def close(self, sqs_client, num_results, dispatched, remaining, failures):
+        """
+        Completes the result file and writes the completion marker, returns False if the chunk failed
+
+        If the deadline left rows unscanned (remaining), they are put back onto the queue as a new, smaller
+        chunk. Rows that timed out or failed to connect are written to a side output and, in the fast lane,
+        scheduled for the slow lane. The marker records how many chunks were spawned this way.
+        If no rows were scanned at all, the original message is put back instead and no marker is written.
+        """
+        if remaining and not dispatched:
+            self.abort()
+            requeue(sqs_client, self.queue_arn, self.message)
+            logger.info("No rows of {} scanned before the deadline, chunk re-queued".format(self.file_name))
+            return True
+
+        # The chunk fails (and its message is redelivered) only if nothing has been queued for it yet:
+        # the files are completed first, then the unscanned rows re-queued, a failure up to here fails the chunk
+        # (redelivery rewrites the same files). Once the remainder is queued the chunk can't fail any more,
+        # so a failure writing the side output or scheduling the slow lane is only logged.
+        spawned = 0
+        if not self.failed:
+            try:
+                self.writer.close()
+                self.upload.close()
+                if self.incremental:
+                    self.bodies_writer.close()
+                    self.bodies_upload.close()
+                    self.s3_client.put_object(Bucket=os.environ['bucket_name'],
+                                              Key=scan_state.state_key(self.scan_date, self.file_name),
+                                              Body=scan_state.encode_state(self.state))
+                if remaining:
+                    remainder = dict(self.message, start_pos=self.message['start_pos'] + dispatched)
+                    requeue(sqs_client, self.queue_arn, remainder)
+                    spawned += 1
+                    logger.info("Re-queued unscanned rows {}-{}".format(remainder['start_pos'], remainder['end_pos']))
+            except Exception as e:
+                logger.error(f"Failed completing {self.file_name}: {type(e).__name__} {e}")
+                self.failed = True
+
+        if self.failed:
+            self.abort()  # uploads that were completed are left as they are
+            return False
+
+        if failures:
+            try:
+                self.write_failures(failures)
+            except Exception as e:
+                logger.error(f"Failed writing the failures of {self.file_name}: {type(e).__name__} {e}")
+            spawned += self.schedule_slow_lane(sqs_client, failures)  # logs the parts it failed to send
+
+        # completion marker, the driver counts these to know when the scan is done
+        status = {'start_pos': self.message['start_pos'],
+                  'end_pos': self.message['end_pos'],
+                  'lane': self.lane,
+                  'domains': dispatched,
+                  'records': num_results,
+                  'failures': len(failures),
+                  'bodies': len(self.stored),
+                  'spawned': spawned,
+                  'elapsed': round(time.time() - self.started, 3)}
+        self.s3_client.put_object(Bucket=os.environ['bucket_name'],
+                                  Key=status_prefix + "{}.json".format(self.file_name),
+                                  Body=json.dumps(status).encode('utf-8'))
+        return True
+
+    def abort(self):
+        self.upload.abort()
+        if self.incremental:
+            self.bodies_upload.abort()
+
+
+def write_metrics(s3_client, outputs, metrics, worker_stats, started):
+    """
+    Logs a summary of the invocation's metrics as one line, and writes it with the histograms under
+    scan_metrics.metrics_prefix (named after the first chunk), for the driver to merge into a report of the scan
+    """
+    summary = scan_metrics.summary(metrics)
+    summary['chunks'] = [output.file_name for output in outputs]
+    summary['elapsed'] = round(time.time() - started, 3)
+    summary['workers'] = lambda_multiproc.summarize_worker_stats(worker_stats, log=False)
+    logger.info("Metrics: {}".format(json.dumps(summary)))
+    s3_client.put_object(Bucket=os.environ['bucket_name'],
+                         Key=scan_metrics.metrics_prefix + "{}.json".format(outputs[0].file_name),
+                         Body=json.dumps({'summary': summary, 'metrics': metrics}).encode('utf-8'))
 
 
 def get_robots(event, context):
 
     """
     Wrapper around init_requests, set the name of the file to read here.
+
+    Every record in the SQS batch is a chunk of the scan, all chunks are scanned together in one pool
+    and each gets its own result file. Chunks that fail are reported in batchItemFailures,
+    so only they are redelivered.
+
+    No new domains are started within deadline_margin seconds (plus the request timeout) of the lambda timeout,
+    results so far are uploaded and the unscanned rows are re-queued.
+
+    Incremental scans (message['incremental']) first load the state of message['previous_scan'] for the batch's rows.
+
+    Timings and outcomes of all requests of the invocation are summarized once it's done, see write_metrics.
     """
+    global state
 
-    s3_prefix = 'robots/'
+    started = time.time()
+    messages = []
+    failures = []
 
-    try:
-        message = json.loads(event['Records'][0]['body'])
-        logger.info(message)
-    except (json.JSONDecodeError, KeyError):
-        logger.error("JSON Decoder error for event: {}".format(event))
-        return {'status': 500}
-
-    message['file_name'] = 'majestic_million.csv'
-    message['function'] = request  # pass the function
-
-    results = lambda_multiproc.init_requests(message)
-    logger.debug("{} results returned".format(len(results)))
-    logger.debug("Requests complete, creating result file")
-
-    # create file_obj in memory, must be in Binary form and implement read()
-    with io.BytesIO() as file_obj:
-        for result in results:
-            file_obj.write(json.dumps(result).encode('utf-8'))
-            file_obj.write('\n'.encode('utf-8'))
-        file_obj.seek(0)  # set to beginning of stream
-        # Upload file to bucket
+    for record in event.get('Records', []):
+        try:
+            message = json.loads(record['body'])
+            logger.info(message)
+            messages.append((record['messageId'], record.get('eventSourceARN'), message))
+        except (json.JSONDecodeError, KeyError):
+            logger.error("JSON Decoder error for record: {}".format(record))
+            failures.append(record.get('messageId'))
+
+    if messages:
+        scan_metrics.take()  # start from scratch, a warm container still holds the previous invocation's
         s3_client = boto3.client('s3')
-        file_name = "{}-{}.{}".format(message['start_pos'], message['end_pos'], 'txt')
+        sqs_client = boto3.client('sqs')
         logger.debug("Uploading to bucket:{}".format(os.environ['bucket_name']))
-        s3_client.upload_fileobj(file_obj, os.environ['bucket_name'], s3_prefix + file_name)
+        outputs = [(message_id, ChunkOutput(s3_client, message, queue_arn, started))
+                   for message_id, queue_arn, message in messages]
+
+        # engine options are taken from the first message, they are the same for every chunk of a scan
+        options = dict(messages[0][2])
+        options['file_name'] = 'majestic_million.csv'
+        options['function'] = functools.partial(request,  # pass the function
+                                                timeout=options.get('timeout', 1.5),
+                                                probe_names=options.get('probes'),
+                                                incremental=options.get('incremental', False))
+        options['async_function'] = functools.partial(async_request,
+                                                      probe_names=options.get('probes'),
+                                                      incremental=options.get('incremental', False))
+        options['prepare'] = prepare_batch
+        options['worker_stats'] = []  # multiproc engine, each worker's stats include its metrics
+        options['ranges'] = [{'start_pos': output.message['start_pos'],
+                              'end_pos': output.message['end_pos'],
+                              'sink': output.write} for message_id, output in outputs]
+        for (message_id, output), scan_range in zip(outputs, options['ranges']):
+            if 'rows' in output.message:  # slow lane
+                scan_range['rows'] = output.message['rows']
+
+        # loaded before scanning, prepare_batch hands it to the multiproc workers
+        state = {}
+        if options.get('incremental') and options.get('previous_scan'):
+            state = scan_state.load_state(s3_client, os.environ['bucket_name'], options['previous_scan'],
+                                          [scan_state.chunk_range(output.file_name) for message_id, output in outputs])
+        if context is not None:
+            # a row makes one request per probe, each with its own timeout,
+            # and a multiproc worker scans chunk_size rows one after another once it's handed them
+            row_time = options.get('timeout', 1.5) * len(probes.get_probes(options.get('probes')))
+            if options.get('engine', 'asyncio') == 'multiproc':
+                row_time *= options.get('chunk_size', 1)
+            options['deadline'] = (time.time() + context.get_remaining_time_in_millis() / 1000
+                                   - row_time - deadline_margin)
+            options['prepare'] = functools.partial(prepare_batch, deadline=options['deadline'])
+
+        try:
+            results = lambda_multiproc.init_requests(options)
+        except Exception:
+            for message_id, output in outputs:
+                output.abort()
+            raise
+
+        for (message_id, output), num_results, scanned in zip(outputs, results, options['ranges']):
+            if output.close(sqs_client, num_results, scanned['dispatched'], scanned['remaining'], scanned['failures']):
+                logger.debug("{} results uploaded for {}".format(num_results, output.file_name))
+            else:
+                failures.append(message_id)
+
+        metrics = scan_metrics.take()
+        for stats in options['worker_stats']:
+            scan_metrics.merge(metrics, stats.pop('metrics'))
+        try:
+            write_metrics(s3_client, [output for message_id, output in outputs], metrics, options['worker_stats'],
+                          started)
+        except Exception as e:  # the scan's results are in, metrics are not worth failing the batch for
+            logger.error(f"Failed writing metrics: {type(e).__name__} {e}")
 
-    return {"status": 200,
-            "file_name": message['file_name']
-            }
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]}
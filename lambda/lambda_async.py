@@ -0,0 +1,81 @@
+import time
+import asyncio
+import logging
+
+import result_stream
+
+# all functions that lambda_async must create this logger
+logger = logging.getLogger('main_logger')
+
+
+async def _worker(work, func, timeout, outputs, deadline):
+    # work is an iterator of (job, row) shared by all workers, each worker pulls the next row when it's free
+    # no new rows are pulled after the deadline, rows already in flight are allowed to finish
+    while deadline is None or time.time() < deadline:
+        item = next(work, None)
+        if item is None:
+            break
+        job, row = item
+        outputs[job]['dispatched'] += 1
+        try:
+            result = await func(row, timeout)
+        except Exception as e:  # one bad row must not take down the whole event loop
+            logger.error(f"Unhandled {type(e).__name__} processing {row.strip()}")
+            continue
+        if result is None:
+            continue
+        output = outputs[job]
+        if isinstance(result, result_stream.Failure):
+            output['failures'].append(result)
+            continue
+        output['count'] += 1
+        if output['sink'] is None:
+            output['results'].append(result)
+        else:
+            output['sink'](result_stream.encode_jsonl([result]))
+
+
+async def _run(jobs, concurrency, func, timeout, deadline, dispatched, failures):
+    outputs = [{'sink': sink, 'results': [], 'count': 0, 'dispatched': 0, 'failures': []} for rows, sink in jobs]
+    work = ((job, row) for job, (rows, sink) in enumerate(jobs) for row in rows)
+    num_rows = sum(len(rows) for rows, sink in jobs)
+    workers = [_worker(work, func, timeout, outputs, deadline) for _ in range(min(concurrency, num_rows))]
+    await asyncio.gather(*workers)
+    if dispatched is not None:
+        dispatched.extend(output['dispatched'] for output in outputs)
+    if failures is not None:
+        failures.extend(output['failures'] for output in outputs)
+    return [output['results'] if output['sink'] is None else output['count'] for output in outputs]
+
+
+def async_batch_requests(jobs, concurrency, func, timeout, deadline=None, dispatched=None, failures=None):
+    """
+    Processes the rows of several jobs together on a single event loop, with up to `concurrency` rows in flight
+
+    jobs: list of (rows, sink) tuples, sink is either None or a callable that each of the job's results
+          is passed to as a JSON line (bytes) as soon as it's ready
+    concurrency, func, timeout: see async_requests
+    deadline: optional time.time() after which no new rows are started
+    dispatched: optional list, filled with the number of rows started for each job. Rows are started in order,
+                so rows[dispatched:] of a job are the ones left unprocessed because of the deadline
+    failures: optional list, filled with a list per job of the result_stream.Failure returned by func
+
+    :return: one entry per job, the list of non-None results, or the number of results written to the job's sink
+    """
+    logger.debug('Processing {} jobs with concurrency {}'.format(len(jobs), concurrency))
+    return asyncio.run(_run(jobs, concurrency, func, timeout, deadline, dispatched, failures))
+
+
+def async_requests(rows, concurrency, func, timeout, sink=None):
+    """
+    Processes all rows on a single event loop, with up to `concurrency` rows in flight
+
+    rows: list of rows to process
+    concurrency: maximum number of rows processed at the same time
+    func: coroutine function called as func(row, timeout), returns a result, None or a result_stream.Failure
+    timeout: per-request timeout passed to func
+    sink: optional callable, each result is passed to it as a JSON line (bytes) as soon as it's ready
+
+    :return: list of non-None results, or the number of results written to sink if sink was provided
+    """
+    return async_batch_requests([(rows, sink)], concurrency, func, timeout)[0]
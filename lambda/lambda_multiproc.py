@@ -1,49 +1,362 @@
+import io
+import os
+import json
 import math
+import pickle
+import time
+import struct
 import logging
+import itertools
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+import lambda_async
+import scan_metrics
+import result_stream
 
 # all functions that lambda_multiproc must create this logger
 logger = logging.getLogger('main_logger')
 
 
-def multiproc_requests(rows, proc_count, func):
-    logger.debug('Spawning {} processes'.format(proc_count))
+def worker(conn):
+    """
+    Runs in a child process of a WorkerPool, processes one batch after another until it receives ('stop', None)
+
+    ('batch', (func, encode, setup)) starts a batch: setup (if not None) is called, then every
+    ('work', (job, rows)) chunk is processed with func(rows), which returns a list of results,
+    until ('done', None) ends the batch. ('ping', None) is answered with ('pong', pid).
+
+    Sends ('result', (job, results, failures)) after every chunk, and ('stats', stats) at the end of the batch
+    failures are the result_stream.Failure items func returned, they are separated from the results
+    stats include the scan_metrics func collected in the worker during the batch
+    If encode is True, results are sent pre-encoded as (number of results, JSON lines bytes)
+    """
+    func, encode = None, False
+    stats, started = None, None
+
+    while True:
+        waiting = time.time()
+        try:
+            kind, payload = conn.recv()
+        except EOFError:  # parent is gone
+            break
+        if stats is not None:
+            stats['idle'] += time.time() - waiting
+
+        if kind == 'stop':
+            break
+        elif kind == 'ping':
+            conn.send(('pong', os.getpid()))
+        elif kind == 'batch':
+            func, encode, setup = payload
+            if setup is not None:
+                setup()
+            scan_metrics.take()
+            stats = {'rows': 0, 'chunks': 0, 'busy': 0.0, 'idle': 0.0}
+            started = time.time()
+        elif kind == 'done':
+            stats['wall'] = time.time() - started
+            stats['metrics'] = scan_metrics.take()
+            conn.send(('stats', stats))
+            stats = None
+        else:
+            job, rows = payload
+            working = time.time()
+            results = func(rows)
+            failures = [result for result in results if isinstance(result, result_stream.Failure)]
+            if failures:
+                results = [result for result in results if not isinstance(result, result_stream.Failure)]
+            stats['busy'] += time.time() - working
+            stats['rows'] += len(rows)
+            stats['chunks'] += 1
+            if encode:
+                conn.send(('result', (job, (len(results), result_stream.encode_jsonl(results)), failures)))
+            else:
+                conn.send(('result', (job, results, failures)))
+
+    conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes that are kept between batches, and between warm invocations of the lambda
+    (module level objects survive until the container is recycled, see get_pool)
+
+    Workers keep their imports and module state, e.g. a requests session with its connection pool.
+    As they are not forked for every batch, func and anything they need from the parent is sent to them
+    with each batch (func must be picklable, e.g. a module level function or a functools.partial of one).
+    """
+
+    def __init__(self):
+        self.workers = []  # list of (process, parent end of its pipe)
+
+    def ready(self, size, ping_timeout=1.0):
+        """
+        Health check: drops workers that died or don't answer a ping, then starts workers until there are
+        at least size. Returns the pipes of size workers, any others stay idle for later, larger batches
+        """
+        for process, conn in self.workers:
+            if process.is_alive():
+                try:
+                    conn.send(('ping', None))
+                except OSError:
+                    pass
+        healthy = []
+        for process, conn in self.workers:
+            try:
+                answered = process.is_alive() and conn.poll(ping_timeout) and conn.recv()[0] == 'pong'
+            except (EOFError, OSError):
+                answered = False
+            if answered:
+                healthy.append((process, conn))
+            else:
+                logger.error("Worker {} failed its health check, replacing it".format(process.pid))
+                self._stop(process, conn)
+
+        self.workers = healthy
+
+        started = 0
+        while len(self.workers) < size:
+            parent_conn, child_conn = Pipe()
+            process = Process(target=worker, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()  # only the worker holds its end, so the pipe reports EOF if the worker dies
+            self.workers.append((process, parent_conn))
+            started += 1
+        logger.info("Using {} of {} pooled processes, {} started".format(size, len(self.workers), started))
+        return [conn for process, conn in self.workers[:size]]
+
+    @staticmethod
+    def _stop(process, conn):
+        try:
+            conn.send(('stop', None))
+        except OSError:
+            pass
+        conn.close()
+        process.join(timeout=1)
+        if process.is_alive():
+            process.terminate()
+
+    def close(self):
+        for process, conn in self.workers:
+            self._stop(process, conn)
+        self.workers = []
+
+
+pool = None  # created on first use, kept for the lifetime of the container
+
+
+def get_pool():
+    global pool
+    if pool is None:
+        pool = WorkerPool()
+    return pool
+
+
+def summarize_worker_stats(worker_stats, log=True):
+    """
+    Logs a summary of worker utilisation (unless log is False), returns the summary as a dict
+    """
+    if not worker_stats:
+        return {}
+
+    tail_idle = sorted(stats.get('tail_idle', 0.0) for stats in worker_stats)
+    summary = {'workers': len(worker_stats),
+               'rows': sum(stats['rows'] for stats in worker_stats),
+               'busy': round(sum(stats['busy'] for stats in worker_stats), 3),
+               'idle': round(sum(stats['idle'] for stats in worker_stats), 3),
+               'tail_idle_median': round(tail_idle[len(tail_idle) // 2], 3),
+               'tail_idle_max': round(tail_idle[-1], 3)}
+    total = summary['busy'] + summary['idle']
+    summary['utilisation'] = round(summary['busy'] / total, 3) if total else 0.0
+
+    if log:
+        logger.info("Worker stats: {}".format(summary))
+    return summary
+
+
+def multiproc_batch_requests(jobs, proc_count, func, chunk_size=1, worker_stats=None, deadline=None, dispatched=None,
+                             failures=None, worker_pool=None, setup=None):
+    """
+    Processes the rows of several jobs together across proc_count processes, using a shared pool of work
+
+    jobs: list of (rows, sink) tuples, sink is either None or a callable that receives the job's results
+          as JSON lines (bytes) as each chunk completes
+    proc_count, func, chunk_size, worker_stats: see multiproc_requests
+    deadline: optional time.time() after which no new rows are handed out, chunks in flight are allowed to finish
+              (a chunk handed out just before it takes chunk_size rows' time, the caller must allow for that)
+    dispatched: optional list, filled with the number of rows handed out for each job. Rows are handed out in order,
+                so rows[dispatched:] of a job are the ones left unprocessed because of the deadline
+    failures: optional list, filled with a list per job of the result_stream.Failure returned by func
+    worker_pool: optional WorkerPool to run on (e.g. get_pool()), by default a pool is started for this call only
+    setup: optional picklable callable, run by every worker before it processes any rows
+
+    :return: one entry per job, the list of results, or the number of results written to the job's sink
+    """
+    num_rows = sum(len(rows) for rows, sink in jobs)
+    proc_count = max(1, min(proc_count, int(math.ceil(num_rows / chunk_size))))
+
+    chunks = iter([(job, rows[k:k + chunk_size])
+                   for job, (rows, sink) in enumerate(jobs)
+                   for k in range(0, len(rows), chunk_size)])
+    encode = any(sink is not None for rows, sink in jobs)
+    num_dispatched = [0] * len(jobs)
+
+    def next_chunk():
+        if deadline is not None and time.time() >= deadline:
+            return 'done', None
+        chunk = next(chunks, None)
+        if chunk is None:
+            return 'done', None
+        num_dispatched[chunk[0]] += len(chunk[1])
+        return 'work', chunk
+
+    temporary = worker_pool is None
+    if temporary:
+        worker_pool = WorkerPool()
+    logger.debug('Using {} processes'.format(proc_count))
+    connections = worker_pool.ready(proc_count)
+
+    logger.debug("Making Requests for {} rows".format(num_rows))
+    batch = pickle.dumps(('batch', (func, encode, setup)))  # pickled once, sent to every worker
+    outputs = [{'sink': sink, 'results': [], 'count': 0, 'failures': []} for rows, sink in jobs]
+    in_flight = {}  # conn: (job, rows) of the chunk the worker is processing
+
+    def lose_worker(conn):
+        # rows of a worker that died were dispatched, they become failures so the job still accounts for them
+        job, rows = in_flight.pop(conn, (None, []))
+        logger.error("Worker exited unexpectedly, {} in-flight rows failed".format(len(rows)))
+        if rows:
+            outputs[job]['failures'].extend(result_stream.Failure(row, 'error') for row in rows)
+
+    def dispatch(conn):
+        kind, chunk = next_chunk()
+        if chunk is not None:
+            in_flight[conn] = chunk
+        try:
+            conn.send((kind, chunk))
+            return True
+        except OSError:
+            lose_worker(conn)
+            return False
+
+    active = []
+    for conn in connections:
+        try:
+            conn.send_bytes(batch)
+        except OSError:
+            logger.error("Worker exited unexpectedly, it is left out of this batch")
+            continue
+        if dispatch(conn):
+            active.append(conn)
+
+    logger.debug("Processes Started, dispatching work")
+
+    stats_list = []
+    try:
+        while active:
+            for conn in wait(active):
+                try:
+                    kind, payload = conn.recv()
+                except (EOFError, OSError):
+                    lose_worker(conn)
+                    active.remove(conn)
+                    continue
+
+                if kind == 'result':
+                    in_flight.pop(conn, None)
+                    job, results, job_failures = payload
+                    if not dispatch(conn):  # hand out more work before handling the result
+                        active.remove(conn)
+                    output = outputs[job]
+                    output['failures'].extend(job_failures)
+                    if encode:
+                        count, data = results
+                        output['count'] += count
+                        if output['sink'] is None:
+                            output['results'].extend(json.loads(line) for line in data.splitlines())
+                        elif data:
+                            output['sink'](data)
+                    else:
+                        output['count'] += len(results)
+                        output['results'].extend(results)
+                elif kind == 'stats':
+                    payload['finished'] = time.time()
+                    stats_list.append(payload)
+                    active.remove(conn)
+    finally:
+        if temporary:
+            worker_pool.close()
+
+    ended = time.time()
+    for stats in stats_list:
+        stats['tail_idle'] = ended - stats.pop('finished')
+
+    if worker_stats is not None:
+        worker_stats.extend(stats_list)
+    if dispatched is not None:
+        dispatched.extend(num_dispatched)
+    if failures is not None:
+        failures.extend(output['failures'] for output in outputs)
+    summarize_worker_stats(stats_list)
+
+    return [output['results'] if output['sink'] is None else output['count'] for output in outputs]
+
 
-    per_proc = int(math.ceil(len(rows) / proc_count))
+def multiproc_requests(rows, proc_count, func, chunk_size=1, worker_stats=None, sink=None):
+    """
+    Processes rows across proc_count processes, using a shared pool of work
 
-    # create a list to keep all processes
-    processes = []
+    Rather than giving each process a fixed slice, the parent hands out chunk_size rows at a time to
+    whichever worker finishes first, so a few slow requests only hold up the worker that drew them.
+    Pipes are used instead of a multiprocessing.Queue because Lambda does not provide /dev/shm.
 
-    # create a list to keep connections
-    parent_connections = []
+    rows: list of rows to process
+    proc_count: number of processes
+    func: function called as func(rows) in the worker processes, returns a list of results
+          (which may include result_stream.Failure items, see multiproc_batch_requests)
+    chunk_size: number of rows handed to a worker at a time
+    worker_stats: optional list, filled with one dict of utilisation stats per worker
+    sink: optional callable, workers encode their results as JSON lines and the parent passes
+          each chunk's bytes to sink as it arrives, instead of collecting them in memory
 
-    # create a process per instance
-    for count in range(proc_count):
-        # create a pipe for communication
-        parent_conn, child_conn = Pipe()
-        parent_connections.append(parent_conn)
+    :return: list of results from all workers, or the number of results written to sink
+    """
+    return multiproc_batch_requests([(rows, sink)], proc_count, func,
+                                    chunk_size=chunk_size, worker_stats=worker_stats)[0]
 
-        # create the process, pass instance and connection
-        sub_list = [x for x in rows[count * per_proc: (count + 1) * per_proc]]
-        process = Process(target=func, args=(sub_list, child_conn,))
-        processes.append(process)
 
-    logger.debug("Making Requests for {} rows".format(len(rows)))
-    # start all processes
-    for process in processes:
-        process.start()
+def read_rows(file, start_pos, end_pos):
+    """
+    Returns rows start_pos to end_pos of file (same as f.readlines()[start_pos:end_pos])
 
-    logger.debug("Processes Started, waiting for closed connections")
+    If an index built by build_layer.py is next to the file (file + '.idx'), seeks straight to the
+    rows using their byte offsets, otherwise falls back to reading the file line by line up to end_pos
+    """
+    index_file = file + '.idx'
 
-    responses = []
-    logger.debug("Reading info")
-    for parent_connection in parent_connections:
-        responses.extend(parent_connection.recv())
+    if not os.path.exists(index_file):
+        logger.debug("No index found for {}, reading rows sequentially".format(file))
+        with open(file, 'r', encoding='utf-8') as f:
+            return list(itertools.islice(f, start_pos, end_pos))
 
-    for process in processes:
-        process.join()
+    num_rows = os.path.getsize(index_file) // 8 - 1
+    start_pos = max(0, min(start_pos, num_rows))
+    end_pos = max(start_pos, min(end_pos, num_rows))
 
-    return responses
+    # read only the two offsets we need, row n spans index[n] to index[n+1]
+    with open(index_file, 'rb') as f:
+        f.seek(start_pos * 8)
+        start_offset, = struct.unpack('<Q', f.read(8))
+        f.seek(end_pos * 8)
+        end_offset, = struct.unpack('<Q', f.read(8))
+
+    with open(file, 'rb') as f:
+        f.seek(start_offset)
+        data = f.read(end_offset - start_offset)
+
+    # decode the same way open(file, 'r') would, so rows match the un-indexed path exactly
+    return io.TextIOWrapper(io.BytesIO(data), encoding='utf-8').readlines()
 
 
 def init_requests(event):
@@ -54,38 +367,91 @@ def init_requests(event):
     passing each row to function
 
     event['file_name'] = File Name to process, file must be in the /opt directory
+                         (the directory of the layer, the layer_dir environment variable overrides it)
     event['start_pos'] = start position (row number) of the file to begin process
     event['end_pos'] = end position (row number) of the file to stop processing
-    event['function'] = function to process each row with
-    event['proc_count] = number of multiple processes to use
+    event['ranges'] = optional list of {'start_pos', 'end_pos', 'sink'} dicts, to process several ranges
+                      together in one pool instead of event['start_pos'] to event['end_pos']
+    event['rows'] = optional list of rows to process instead of the file, start_pos and end_pos index into it
+                    (also accepted on each of event['ranges'])
+    event['engine'] = 'asyncio' (default) or 'multiproc'
+    event['function'] = function to process each row with, must be picklable (multiproc engine)
+    event['proc_count] = number of multiple processes to use (multiproc engine)
+    event['chunk_size'] = number of rows handed to a process at a time (multiproc engine)
+    event['worker_stats'] = optional list to be filled with per-process utilisation stats (multiproc engine)
+    event['async_function'] = coroutine function to process each row with (asyncio engine)
+    event['concurrency'] = maximum number of requests in flight (asyncio engine)
+    event['timeout'] = per-request timeout in seconds (asyncio engine)
+    event['sink'] = optional callable, results are streamed to it as JSON lines (bytes) instead of returned
+    event['deadline'] = optional time.time() after which no new rows are started
+    event['prepare'] = optional callable, called with the list of all rows before any are processed.
+                       It may return a picklable callable, which every worker of the multiproc engine runs before
+                       processing rows (the workers are kept between invocations, see WorkerPool, so they don't
+                       share the state prepare sets up in this process)
 
-    :return:
+    After processing, event['dispatched'] and event['remaining'] (or the same keys of each of event['ranges'])
+    are set to the number of rows started, and the number of rows after those that were skipped because of
+    the deadline. event['failures'] is set to the list of result_stream.Failure returned for the rows
+
+    :return: list of results, or the number of results written to event['sink']
+             if event['ranges'] is provided, a list with one such entry per range
     """
 
     logger.debug("Starting...")
     # File is either provided in event['file_name'] or defaults to random_top-1m.csv
-    file = "/opt/{}".format(event.get('file_name', 'random_top-1m.csv'))
+    file = os.path.join(os.environ.get('layer_dir', '/opt'), event.get('file_name', 'random_top-1m.csv'))
     logger.debug("Retrieving rows from {}".format(file))
 
-    rows = []
-    if 'end_pos' in event and 'start_pos' in event:
-        logger.debug("Opening {}".format(file))
-
-        with open(file, 'r', encoding='utf-8') as f:
-            rows = f.readlines()[event['start_pos']:event['end_pos']]
-
-        logger.debug("Processing {} rows from file".format(len(rows)))
+    if 'ranges' in event:
+        ranges = event['ranges']
+    elif 'end_pos' in event and 'start_pos' in event:
+        ranges = [event]
     else:
         logger.error("Error in arguments, start_pos and end_pos not found!!")
         exit(1)
 
-    proc_count = event.get('proc_count', 125)
-    logger.info("Requesting {} rows from {} to {} with {} procs".format(len(rows),
-                                                                        rows[0],
-                                                                        rows[-1],
-                                                                        proc_count))
-    try:
-        results = multiproc_requests(rows, proc_count, event['function'])
-    except EOFError:
-        return {}
-    return results
+    logger.debug("Opening {}".format(file))
+    jobs = [(job['rows'][job['start_pos']:job['end_pos']] if 'rows' in job
+             else read_rows(file, job['start_pos'], job['end_pos']), job.get('sink')) for job in ranges]
+    num_rows = sum(len(rows) for rows, sink in jobs)
+    logger.debug("Processing {} rows from file".format(num_rows))
+    setup = None
+    if event.get('prepare'):
+        setup = event['prepare']([row for rows, sink in jobs for row in rows])
+
+    dispatched = []
+    failures = []
+    if event.get('engine', 'asyncio') == 'asyncio':
+        # Lambda limits a function to 1024 file descriptors, keep concurrency below that
+        concurrency = event.get('concurrency', 500)
+        logger.info("Requesting {} rows from {} ranges with concurrency {}".format(num_rows,
+                                                                                   len(jobs),
+                                                                                   concurrency))
+        results = lambda_async.async_batch_requests(jobs, concurrency, event['async_function'],
+                                                    event.get('timeout', 1.5),
+                                                    deadline=event.get('deadline'),
+                                                    dispatched=dispatched,
+                                                    failures=failures)
+    else:
+        proc_count = event.get('proc_count', 125)
+        logger.info("Requesting {} rows from {} ranges with {} procs".format(num_rows,
+                                                                             len(jobs),
+                                                                             proc_count))
+        results = multiproc_batch_requests(jobs, proc_count, event['function'],
+                                           chunk_size=event.get('chunk_size', 1),
+                                           worker_stats=event.get('worker_stats'),
+                                           deadline=event.get('deadline'),
+                                           dispatched=dispatched,
+                                           failures=failures,
+                                           worker_pool=get_pool(),
+                                           setup=setup)
+
+    for job, (rows, sink), num_dispatched, job_failures in zip(ranges, jobs, dispatched, failures):
+        job['dispatched'] = num_dispatched
+        job['failures'] = job_failures
+        job['remaining'] = len(rows) - num_dispatched
+        if job['remaining']:
+            logger.info("Deadline reached, {} rows from {} not started".format(job['remaining'],
+                                                                               job['start_pos'] + num_dispatched))
+
+    return results if 'ranges' in event else results[0]
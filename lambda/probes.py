@@ -0,0 +1,88 @@
+import json
+import logging
+import collections
+
+logger = logging.getLogger('main_logger')
+
+# Probes are the requests made to every host of a scan, each result becomes a column named after the probe.
+# All probes of a host are made one after another over the same (keep-alive) connection.
+# This module only uses the standard library, the driver loads it to generate the Athena schema.
+#
+#   name: column the result is written to
+#   path: requested on http://<domain>, the final url (after redirects) must end with it
+#   method: 'GET', or 'HEAD' to record the response headers only
+#   max_size: the body is abandoned once it grows past this
+#   content_types: accepted Content-Type prefixes, a missing Content-Type is always accepted
+#   markup: True if the body must start with '<' (XML), False if it must not (soft-404 pages are HTML)
+#   contains: the body (lower-cased) must contain at least one of these
+Probe = collections.namedtuple('Probe', ['name', 'path', 'method', 'max_size', 'content_types', 'markup', 'contains'])
+
+available = {
+    'robots.txt': Probe('robots.txt', '/robots.txt', 'GET', 1024 * 1024,
+                        ('text/', 'application/octet-stream'), False, ('user-agent:',)),
+    'security.txt': Probe('security.txt', '/.well-known/security.txt', 'GET', 64 * 1024,
+                          ('text/', 'application/octet-stream'), False, ('contact:',)),
+    'sitemap.xml': Probe('sitemap.xml', '/sitemap.xml', 'GET', 1024 * 1024,
+                         ('text/xml', 'application/xml', 'text/plain', 'application/octet-stream'),
+                         True, ('<urlset', '<sitemapindex')),
+    'headers': Probe('headers', '/', 'HEAD', 0, None, None, ()),
+}
+default_probes = ['robots.txt']
+
+sniff_size = 4096  # bytes of the body checked by accept_body before the rest is read
+
+
+def get_probes(names=None):
+    """
+    Returns the Probe of each name (default_probes if None), raises KeyError for unknown probes
+    """
+    return [available[name] for name in (names or default_probes)]
+
+
+def columns(names=None):
+    """
+    Keys of every result record, in order
+    """
+    return ['domain'] + [probe.name for probe in get_probes(names)]
+
+
+def accept_headers(probe, response):
+    """
+    Checks status, final url and Content-Type before any of the body is read
+    Works on both requests and async_http responses (both have case-insensitive access to content-type)
+    """
+    if probe.method == 'HEAD':
+        return True
+    if response.status_code != 200 or not response.url.endswith(probe.path):
+        return False
+    content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+    return not content_type or content_type.startswith(probe.content_types)
+
+
+def accept_body(probe, head):
+    """
+    Checks the first sniff_size bytes of the body
+    """
+    if probe.markup is None:
+        return True
+    return head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<') == probe.markup
+
+
+def value(probe, response, content):
+    """
+    Returns the column value for a response, or None if the probe found nothing
+    The body is decoded once, and must be valid utf-8 and contain one of probe.contains
+    """
+    if probe.method == 'HEAD':
+        return json.dumps({'status': response.status_code,
+                           'url': response.url,
+                           'headers': dict(response.headers)})
+    try:
+        text = content.decode('utf-8')
+    except UnicodeDecodeError:
+        logger.error(f"{probe.name} for {response.url} is not properly encoded")
+        return None
+    lowered = text.lower()
+    if not any(marker in lowered for marker in probe.contains):
+        return None
+    return text
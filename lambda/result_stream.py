@@ -0,0 +1,215 @@
+import io
+import json
+import zlib
+import logging
+import threading
+import collections
+import concurrent.futures
+
+try:
+    import pyarrow  # optional, only needed for parquet output
+    import pyarrow.json
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('main_logger')
+
+min_part_size = 5 * 1024 * 1024  # S3 minimum for every part except the last
+
+# returned by a row function instead of a result when the row failed in a way worth retrying,
+# the engines collect these separately from results (reason is e.g. 'timeout' or 'connect')
+Failure = collections.namedtuple('Failure', ['row', 'reason'])
+
+
+def encode_jsonl(records):
+    """
+    Encodes a list of dictionaries as JSON lines, returns bytes
+    """
+    return b''.join(json.dumps(record).encode('utf-8') + b'\n' for record in records)
+
+
+class MultipartUpload:
+    """
+    File-like sink that streams bytes into an S3 object as they are written
+
+    Data is buffered until part_size is reached, and each part is uploaded from a background thread
+    so that uploading overlaps with scanning. The multipart upload is also created from the background thread,
+    so write never waits on S3 (it's called from the asyncio engine's event loop) unless uploads fall behind:
+    at most 2 * max_workers parts are held in memory, write blocks until one of them is uploaded.
+    Objects smaller than one part are sent with a single put_object on close.
+    If an exception occurs inside a `with` block, the upload is aborted.
+
+    usage:
+        with MultipartUpload(s3_client, bucket, key) as upload:
+            upload.write(b'...')
+    """
+
+    def __init__(self, client, bucket, key, part_size=8 * 1024 * 1024, max_workers=2):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, min_part_size)
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.upload_id = None  # future of the UploadId, once the first part is flushed
+        self.parts = []
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(2 * max_workers)  # parts queued or uploading
+        self.completed = False
+
+    def _create_upload(self):
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        logger.debug("Started multipart upload of {}".format(self.key))
+        return response['UploadId']
+
+    def _upload_part(self, part_number, data):
+        # the create was submitted before any part, so it's already running (or done) on another thread
+        response = self.client.upload_part(Bucket=self.bucket,
+                                           Key=self.key,
+                                           UploadId=self.upload_id.result(),
+                                           PartNumber=part_number,
+                                           Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _flush_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.executor.submit(self._create_upload)
+
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.slots.acquire()
+        part = self.executor.submit(self._upload_part, len(self.parts) + 1, data)
+        part.add_done_callback(lambda future: self.slots.release())
+        self.parts.append(part)
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._flush_part()
+        return len(data)
+
+    def close(self):
+        """
+        Uploads any remaining data and completes the upload, returns total bytes written
+        """
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self._flush_part()
+            parts = [future.result() for future in self.parts]
+            self.client.complete_multipart_upload(Bucket=self.bucket,
+                                                  Key=self.key,
+                                                  UploadId=self.upload_id.result(),
+                                                  MultipartUpload={'Parts': parts})
+        self.completed = True
+        self.executor.shutdown()
+        logger.debug("Uploaded {} bytes to {}".format(self.bytes_written, self.key))
+        return self.bytes_written
+
+    def abort(self):
+        """
+        Aborts the multipart upload, unless it was already completed by close
+        """
+        self.executor.shutdown()
+        if self.completed:
+            return
+        if self.upload_id is not None and self.upload_id.exception() is None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id.result())
+            logger.error("Aborted multipart upload of {}".format(self.key))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class GzipWriter:
+    """
+    Compresses everything written to it into a single gzip stream, written through to sink
+    """
+
+    def __init__(self, sink, columns=None):
+        self.sink = sink
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.sink.write(compressed)
+        return len(data)
+
+    def close(self):
+        self.sink.write(self.compressor.flush())
+
+
+class ParquetWriter:
+    """
+    Collects JSON lines and writes them to sink as a single parquet file on close
+    Parquet can't be appended to, so unlike the other formats the output is buffered
+    """
+
+    def __init__(self, sink, columns):
+        if pyarrow is None:
+            raise RuntimeError("parquet output requested, but the pyarrow package is not available")
+        self.sink = sink
+        self.schema = pyarrow.schema([(name, pyarrow.string()) for name in columns])
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def close(self):
+        if self.buffer.tell():
+            self.buffer.seek(0)
+            table = pyarrow.json.read_json(self.buffer,
+                                           parse_options=pyarrow.json.ParseOptions(explicit_schema=self.schema))
+        else:
+            table = self.schema.empty_table()
+        out = io.BytesIO()
+        pyarrow.parquet.write_table(table, out, compression='snappy')
+        self.sink.write(out.getvalue())
+
+
+class PlainWriter:
+    """
+    Writes JSON lines through to sink unchanged
+    """
+
+    def __init__(self, sink, columns=None):
+        self.sink = sink
+
+    def write(self, data):
+        return self.sink.write(data)
+
+    def close(self):
+        pass
+
+
+# output_format: (file extension, writer)
+output_formats = {'jsonl': ('txt', PlainWriter),
+                  'jsonl.gz': ('json.gz', GzipWriter),
+                  'parquet': ('parquet', ParquetWriter)}
+
+
+def format_writer(sink, output_format, columns):
+    """
+    Returns a writer for output_format ('jsonl', 'jsonl.gz' or 'parquet') that takes JSON lines and writes
+    the encoded output to sink. The writer must be closed before sink is closed.
+    columns is the list of record keys, needed for parquet's schema
+    """
+    return output_formats[output_format][1](sink, columns)
+
+
+def output_key(prefix, scan_date, file_name, output_format):
+    """
+    Key of a result file, partitioned by scan date (Hive style, so Athena can project the partition)
+    """
+    return f"{prefix}scan_date={scan_date}/{file_name}.{output_formats[output_format][0]}"
@@ -0,0 +1,92 @@
+import bisect
+
+# Timings and outcomes of the requests of a scan, kept as histograms so they stay small and can be merged:
+# every process collects its own (current), the invocation merges those of its workers into one summary
+# (written under metrics_prefix), and the driver merges the summaries of all invocations into a report of the scan.
+# This module only uses the standard library, the driver loads it to merge the summaries.
+#
+#   phases: prefetch (resolving the batch's hosts before scanning), dns, connect (TCP), tls (TCP and TLS, for https),
+#           ttfb (request sent until the response headers are read), body, total (a probe's request, redirects included)
+#   outcomes of a probe's request: found, not_found, not_modified, rejected, timeout, connect, error,
+#           and nxdomain for hosts that were skipped
+# The requests engine can't see inside a connection, its ttfb includes connecting (see get_robots.fetch)
+
+metrics_prefix = 'metrics/'
+bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)  # the last bucket is above these
+
+
+def new():
+    return {'phases': {}, 'outcomes': {}, 'bytes': 0}
+
+
+current = new()  # metrics of this process, since the last take()
+
+
+def observe(phase, seconds, metrics=None):
+    """
+    Adds a timing of phase to the histogram of metrics (default current)
+    """
+    metrics = current if metrics is None else metrics
+    histogram = metrics['phases'].get(phase)
+    if histogram is None:
+        histogram = metrics['phases'][phase] = {'counts': [0] * (len(bounds_ms) + 1), 'sum': 0.0}
+    histogram['counts'][bisect.bisect_left(bounds_ms, seconds * 1000)] += 1
+    histogram['sum'] += seconds
+
+
+def outcome(code, num_bytes=0, metrics=None):
+    metrics = current if metrics is None else metrics
+    metrics['outcomes'][code] = metrics['outcomes'].get(code, 0) + 1
+    metrics['bytes'] += num_bytes
+
+
+def take():
+    """
+    Returns the metrics collected by this process, and starts collecting anew
+    """
+    global current
+    taken, current = current, new()
+    return taken
+
+
+def merge(into, metrics):
+    """
+    Adds metrics to into, returns into
+    """
+    for phase, histogram in metrics['phases'].items():
+        merged = into['phases'].setdefault(phase, {'counts': [0] * (len(bounds_ms) + 1), 'sum': 0.0})
+        merged['counts'] = [a + b for a, b in zip(merged['counts'], histogram['counts'])]
+        merged['sum'] += histogram['sum']
+    for code, count in metrics['outcomes'].items():
+        into['outcomes'][code] = into['outcomes'].get(code, 0) + count
+    into['bytes'] += metrics['bytes']
+    return into
+
+
+def percentile(histogram, fraction):
+    """
+    Upper bound in ms of the bucket the fraction-th timing falls in, None if it's above the last bound
+    """
+    counts = histogram['counts']
+    target = fraction * sum(counts)
+    seen = 0
+    for bound, count in zip(bounds_ms + (None,), counts):
+        seen += count
+        if count and seen >= target:
+            return bound
+    return None
+
+
+def summary(metrics):
+    """
+    Readable summary of metrics: counts, mean and percentiles (ms) of every phase, outcomes and bytes
+    """
+    phases = {}
+    for phase, histogram in sorted(metrics['phases'].items()):
+        count = sum(histogram['counts'])
+        phases[phase] = {'count': count,
+                         'mean': round(histogram['sum'] / count * 1000, 1) if count else None,
+                         'p50': percentile(histogram, 0.5),
+                         'p95': percentile(histogram, 0.95),
+                         'p99': percentile(histogram, 0.99)}
+    return {'phases': phases, 'outcomes': dict(sorted(metrics['outcomes'].items())), 'bytes': metrics['bytes']}
@@ -0,0 +1,61 @@
+import gzip
+import json
+import hashlib
+import logging
+import concurrent.futures
+
+# State of incremental scans, kept in the bucket between scans:
+#   state/scan_date=YYYY-MM-DD/<file_name>.json.gz   {host: {probe name: [etag, last_modified, content hash]}}
+# one file per chunk, named like the chunk's result file. A chunk loads the state files of the previous scan
+# whose rows overlap its own, so the previous scan doesn't need to have been split into the same chunks.
+
+logger = logging.getLogger('main_logger')
+
+state_prefix = 'state/'
+
+
+def body_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def state_key(scan_date, file_name):
+    return f"{state_prefix}scan_date={scan_date}/{file_name}.json.gz"
+
+
+def chunk_range(file_name):
+    """
+    Rows of the scan covered by a chunk's file, e.g. '1250-2500' and '1250-2500.slow.0-13' both cover 1250-2500
+    """
+    start_pos, end_pos = file_name.split('.')[0].split('-')
+    return int(start_pos), int(end_pos)
+
+
+def encode_state(state):
+    return gzip.compress(json.dumps(state, separators=(',', ':')).encode('utf-8'))
+
+
+def load_state(client, bucket_name, scan_date, ranges, max_workers=8):
+    """
+    Loads the state of scan_date for the rows in ranges (list of (start_pos, end_pos) tuples)
+    returns dict of host: {probe name: [etag, last_modified, content hash]}
+    """
+    prefix = f"{state_prefix}scan_date={scan_date}/"
+    keys = []
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            start_pos, end_pos = chunk_range(obj['Key'][len(prefix):])
+            if any(start_pos < range_end and range_start < end_pos for range_start, range_end in ranges):
+                keys.append(obj['Key'])
+
+    def load(key):
+        body = client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+        return json.loads(gzip.decompress(body).decode('utf-8'))
+
+    state = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for hosts in executor.map(load, keys):
+            for host, entries in hosts.items():
+                state.setdefault(host, {}).update(entries)
+    logger.info("Loaded state of {} hosts from {} files of scan {}".format(len(state), len(keys), scan_date))
+    return state
@@ -0,0 +1,129 @@
+import json
+import math
+import time
+import logging
+import statistics
+
+# Picks the shape of a scan (rows per chunk, number of chunks, processes and reserved concurrency)
+# from the throughput measured in earlier scans, recorded in history_file after every scan.
+
+history_file = 'scan_history.jsonl'
+
+# domains per second of one invocation, assumed until a scan with the same engine has been measured
+default_rates = {'asyncio': 60.0, 'multiproc': 20.0}
+default_settings = {'asyncio': 500, 'multiproc': 125}  # concurrency, or proc_count
+min_unreserved = 100  # AWS keeps at least this much of the account's concurrency unreserved
+min_per_lambda = 50  # smaller chunks spend more time starting up than scanning
+timeout_margin = 0.7  # plan invocations to use at most this share of the function timeout
+
+
+def record_scan(report, engine, setting, per_lambda, batch_size, path=history_file):
+    """
+    Appends the measurements of a finished scan (report of invocations.track_completion) to the history
+    setting is the engine's concurrency (asyncio) or proc_count (multiproc)
+    """
+    rates = [domains / elapsed for domains, elapsed in report.get('chunk_stats', []) if domains and elapsed]
+    if not rates:
+        return None
+    entry = {'date': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()),
+             'engine': engine,
+             'setting': setting,
+             'per_lambda': per_lambda,
+             'batch_size': batch_size,
+             'domains': report['domains'],
+             'chunks': len(rates),
+             # a chunk's elapsed time is that of its invocation, which scans batch_size chunks together
+             'invocation_rate': round(statistics.median(rates) * batch_size, 3)}
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def load_history(path=history_file):
+    try:
+        with open(path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def measured_rate(history, engine):
+    """
+    Returns the setting with the best measured throughput for engine, and that throughput
+    (median over the scans with that setting, weighted towards the most recent 5)
+    """
+    by_setting = {}
+    for entry in history:
+        if entry['engine'] == engine:
+            by_setting.setdefault(entry['setting'], []).append(entry['invocation_rate'])
+    if not by_setting:
+        return default_settings[engine], default_rates[engine]
+
+    rates = {setting: statistics.median(measured[-5:]) for setting, measured in by_setting.items()}
+    setting = max(rates, key=rates.get)
+    return setting, rates[setting]
+
+
+def available_concurrency(lambda_client, function_name):
+    """
+    Concurrency the scan function can reserve: the account's unreserved concurrency,
+    plus what the function already reserves, less the minimum AWS keeps unreserved
+    """
+    account = lambda_client.get_account_settings()['AccountLimit']
+    reserved = lambda_client.get_function_concurrency(FunctionName=function_name).get('ReservedConcurrentExecutions', 0)
+    return max(1, account['UnreservedConcurrentExecutions'] + reserved - min_unreserved)
+
+
+def plan(total_domains, budget, concurrency_limit, rate, batch_size, function_timeout):
+    """
+    Args:
+        total_domains: number of domains to scan
+        budget: wall clock seconds the scan should finish in
+        concurrency_limit: maximum concurrent invocations
+        rate: domains per second of one invocation
+        batch_size: chunks (sqs messages) scanned together per invocation
+        function_timeout: timeout of the scan function in seconds
+    Spreads the domains over as many concurrent invocations as allowed, so everything runs in one wave,
+    unless that would make an invocation run longer than timeout_margin of the function timeout,
+    in which case invocations are capped at that and run in several waves.
+    :return
+        dict of per_lambda (rows per chunk), num_invocations (chunks), concurrent (invocations to reserve),
+        waves and expected_seconds
+    """
+    max_rows = max(min_per_lambda, int(function_timeout * timeout_margin * rate / batch_size))
+    per_lambda = math.ceil(total_domains / (batch_size * concurrency_limit))
+    per_lambda = min(max(per_lambda, min_per_lambda), max_rows)
+
+    num_invocations = math.ceil(total_domains / per_lambda)
+    concurrent = min(concurrency_limit, math.ceil(num_invocations / batch_size))
+    waves = math.ceil(num_invocations / batch_size / concurrent)
+    expected_seconds = round(waves * batch_size * per_lambda / rate, 1)
+
+    result = {'per_lambda': per_lambda,
+              'num_invocations': num_invocations,
+              'concurrent': concurrent,
+              'waves': waves,
+              'expected_seconds': expected_seconds}
+
+    logger = logging.getLogger('__main__')
+    logger.info(f"Plan for {total_domains:,} domains at {rate:.1f} domains/s per invocation: {result}")
+    if expected_seconds > budget:
+        logger.warning(f"Expected to take {expected_seconds}s, over the budget of {budget}s "
+                       f"with {concurrency_limit} concurrent invocations")
+    return result
+
+
+def shard(num_chunks, capacities):
+    """
+    Splits num_chunks between regions in proportion to capacities (dict of region: concurrency available there),
+    the chunks left over by rounding down go to the regions with the largest remainders
+    :return
+        dict of region: number of chunks
+    """
+    total = sum(capacities.values())
+    exact = {region: num_chunks * capacity / total for region, capacity in capacities.items()}
+    counts = {region: int(share) for region, share in exact.items()}
+    by_remainder = sorted(exact, key=lambda region: exact[region] - counts[region], reverse=True)
+    for region in by_remainder[:num_chunks - sum(counts.values())]:
+        counts[region] += 1
+    return counts
@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import zlib
+import tempfile
+import functools
+import types
+import threading
+import collections
+import multiprocessing
+
+import invocations
+
+# The lambda's modules are imported from lambda/, ahead of this directory,
+# so that get_robots is the lambda handler and not the driver script of the same name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lambda'))
+import get_robots as handler  # noqa: E402
+import build_layer  # noqa: E402
+import scan_metrics  # noqa: E402
+import lambda_multiproc  # noqa: E402
+
+# Offline end-to-end simulation of a scan, for measuring changes to the scan engines without AWS or the internet.
+#
+# A farm of local HTTP servers stands in for the domains, one server per profile (how a domain behaves),
+# and a synthetic majestic_million.csv (with its index, as in the layer) lists domains spread over the profiles.
+# The scan's messages are put onto an in-process SQS stand-in with invocations.split_and_put_into_ques, and the real
+# get_robots handler is invoked on batches of them, one invocation after another (one warm container), writing to an
+# in-process S3 stand-in, until both the queue and the slow lane queue are empty.
+#
+# Reports domains per second, latency of rows (time from starting a row to its result), peak memory,
+# and the request metrics of all invocations (see scan_metrics).
+
+farm_profiles = {
+    'ok': 'answers every probe',
+    'slow': 'answers every probe after an extra latency',
+    'timeout': 'accepts connections but never answers',
+    'redirect': 'redirects every path once, then answers like ok',
+    'large': 'robots.txt (etc.) larger than the probes accept, chunked',
+    'latin1': 'robots.txt (etc.) that is not utf-8',
+    'soft404': 'answers every path with a html page',
+    'missing': 'answers every path with a 404',
+    'refused': 'nothing listening, connections are refused',
+}
+found_profiles = ('ok', 'slow', 'redirect')  # domains the GET probes find something on
+default_mix = 'ok=60,slow=10,timeout=4,redirect=10,large=3,latin1=4,soft404=4,missing=3,refused=2'
+large_size = 2 * 1024 * 1024
+
+documents = {
+    '/robots.txt': ('text/plain', b'User-agent: *\nDisallow: /private/\nSitemap: /sitemap.xml\n'),
+    '/.well-known/security.txt': ('text/plain', b'Contact: mailto:security@example.com\n'),
+    '/sitemap.xml': ('application/xml', b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                                        b'<urlset><url><loc>http://example.com/</loc></url></urlset>\n'),
+    '/': ('text/html', b'<html><body>Home</body></html>\n'),
+}
+last_modified = 'Mon, 01 Jun 2020 00:00:00 GMT'
+
+majestic_header = ('GlobalRank,TldRank,Domain,TLD,RefSubNets,RefIPs,IDN_Domain,IDN_TLD,'
+                   'PrevGlobalRank,PrevTldRank,PrevRefSubNets,PrevRefIPs')
+
+bucket_name = 'simulation'
+queue_name = 'simulation-queue'
+slow_queue_name = 'simulation-slow-queue'
+
+default_settings = {'domains': 2000,
+                    'per_lambda': 250,
+                    'engine': 'asyncio',
+                    'concurrency': 500,
+                    'proc_count': 125,
+                    'chunk_size': 1,
+                    'timeout': 1.5,
+                    'slow_timeout': 5,
+                    'slow_concurrency': 800,
+                    'output_format': 'jsonl',
+                    'probes': ['robots.txt'],
+                    'mix': default_mix,
+                    'delay': 0.02,  # seconds every response is delayed by, the round trip of a real network
+                    'latency': 0.5,  # extra seconds the slow profile's responses are delayed by
+                    'seed': 0}
+
+
+def respond(profile, path, request_headers):
+    """
+    Returns status, headers, body and whether the body is sent chunked, for a request to a domain of profile
+    """
+    if profile == 'redirect':
+        if not path.startswith('/moved/'):
+            return 301, {'Location': '/moved' + path}, b'', False
+        path = path[len('/moved'):]
+    if profile == 'missing' or path not in documents:
+        return 404, {'Content-Type': 'text/html'}, b'<html><body>Not Found</body></html>\n', False
+    if profile == 'soft404':
+        return 200, {'Content-Type': 'text/html'}, b'<html><body>Sorry, nothing here</body></html>\n', False
+
+    content_type, body = documents[path]
+    if profile == 'latin1':
+        body += b'# caf\xe9\n'
+    elif profile == 'large':
+        body += b'#' * large_size
+    etag = '"{:x}"'.format(zlib.crc32(body))
+    response_headers = {'Content-Type': content_type, 'ETag': etag, 'Last-Modified': last_modified}
+    if request_headers.get('if-none-match') == etag:
+        return 304, response_headers, b'', False
+    return 200, response_headers, body, profile == 'large'
+
+
+async def serve_connection(profile, delay, latency, reader, writer):
+    """
+    Answers the requests of one (keep-alive) connection to a domain of profile
+    """
+    try:
+        while True:
+            head = await reader.readuntil(b'\r\n\r\n')
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            method, path = request_line.split()[:2]
+            request_headers = {}
+            for line in header_lines:
+                name, _, value = line.partition(':')
+                request_headers[name.strip().lower()] = value.strip()
+
+            if profile == 'timeout':
+                await reader.read()  # until the client gives up
+                return
+            await asyncio.sleep(delay + (latency if profile == 'slow' else 0))
+
+            status, response_headers, body, chunked = respond(profile, path, request_headers)
+            if chunked:
+                response_headers['Transfer-Encoding'] = 'chunked'
+            else:
+                response_headers['Content-Length'] = str(len(body))
+            if method == 'HEAD':
+                body, chunked = b'', False
+            lines = [f"HTTP/1.1 {status} Sim"] + [f"{name}: {value}" for name, value in response_headers.items()]
+            writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+            if chunked:
+                for start in range(0, len(body), 64 * 1024):
+                    block = body[start:start + 64 * 1024]
+                    writer.write(b'%x\r\n%s\r\n' % (len(block), block))
+                    await writer.drain()
+                writer.write(b'0\r\n\r\n')
+            else:
+                writer.write(body)
+            await writer.drain()
+
+            if request_headers.get('connection', '').lower() == 'close':
+                return
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_farm(sockets, delay, latency):
+    """
+    Serves the farm's listening sockets (list of (profile, socket)) until the process is terminated
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for profile, sock in sockets:
+        loop.run_until_complete(asyncio.start_server(functools.partial(serve_connection, profile, delay, latency),
+                                                     sock=sock, backlog=1024))
+    loop.run_forever()
+
+
+class HostFarm:
+    """
+    Local HTTP servers on 127.0.0.1, one port per profile, served by a separate process
+    so that they don't compete with the scan for the scanning process's CPU time
+
+    usage:
+        with HostFarm(delay=0.02, latency=0.5) as farm:
+            host = farm.host('slow')  # '127.0.0.1:<port>'
+    """
+
+    def __init__(self, delay, latency):
+        self.delay = delay
+        self.latency = latency
+        self.ports = {}
+        self.process = None
+
+    def start(self):
+        sockets = []
+        for profile in farm_profiles:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            self.ports[profile] = sock.getsockname()[1]
+            if profile == 'refused':
+                sock.close()  # the port is left with nothing listening on it
+            else:
+                sock.listen(1024)
+                sockets.append((profile, sock))
+
+        self.process = multiprocessing.Process(target=run_farm, args=(sockets, self.delay, self.latency), daemon=True)
+        self.process.start()
+        for profile, sock in sockets:
+            sock.close()  # the farm's process holds its own copies
+        return self
+
+    def host(self, profile):
+        return f"127.0.0.1:{self.ports[profile]}"
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def parse_mix(mix):
+    """
+    'ok=60,slow=10' -> {'ok': 60.0, 'slow': 10.0}, raises ValueError for unknown profiles
+    """
+    weights = {}
+    for item in mix.split(','):
+        profile, _, weight = item.partition('=')
+        if profile.strip() not in farm_profiles:
+            raise ValueError(f"Unknown profile {profile!r}, choose from {', '.join(farm_profiles)}")
+        weights[profile.strip()] = float(weight)
+    return weights
+
+
+def write_domains(layer_dir, farm, num_domains, mix, seed):
+    """
+    Writes a majestic_million.csv (and its index) of num_domains domains on the farm, spread over its profiles
+    by the weights in mix. Row 0 is the header, as in the real file. Returns the number of domains per profile
+    """
+    weights = parse_mix(mix)
+    chosen = random.Random(seed).choices(list(weights), weights=list(weights.values()), k=num_domains)
+
+    csv_file = os.path.join(layer_dir, build_layer.csv_name)
+    with open(csv_file, 'w') as f:
+        f.write(majestic_header + '\n')
+        for rank, profile in enumerate(chosen, 1):
+            host = farm.host(profile)
+            f.write(f"{rank},{rank},{host},sim,0,0,{host},sim,{rank},{rank},0,0\n")
+    build_layer.write_index(csv_file)
+    return collections.Counter(chosen)
+
+
+class FakeS3:
+    """
+    In-process stand-in for the parts of the boto3 S3 client used by the lambda, keeps objects in memory
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()  # parts are uploaded from result_stream's threads
+
+    def put_object(self, Bucket, Key, Body):
+        with self.lock:
+            self.objects[Key] = bytes(Body)
+        return {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        with self.lock:
+            self.uploads[UploadId][PartNumber] = bytes(Body)
+        return {'ETag': f'"{UploadId}-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        with self.lock:
+            parts = self.uploads.pop(UploadId)
+            self.objects[Key] = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def get_paginator(self, operation_name):
+        return self  # only list_objects_v2 is used
+
+    def paginate(self, Bucket, Prefix=''):
+        with self.lock:
+            keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        yield {'Contents': [{'Key': key, 'Size': len(self.objects[key])} for key in keys]}
+
+    def read_json(self, prefix):
+        return [json.loads(self.objects[key]) for key in sorted(self.objects) if key.startswith(prefix)]
+
+
+class FakeSQS:
+    """
+    In-process stand-in for the parts of the boto3 SQS client used by the driver and the lambda
+    """
+
+    account = '000000000000'
+
+    def __init__(self, queue_names):
+        self.queues = {self.queue_url(name): collections.deque() for name in queue_names}
+
+    def queue_url(self, name):
+        return f"https://sqs.local/{self.account}/{name}"
+
+    def queue_arn(self, name):
+        return f"arn:aws:sqs:local:{self.account}:{name}"
+
+    def get_queue_url(self, QueueName, QueueOwnerAWSAccountId=None):
+        return {'QueueUrl': self.queue_url(QueueName)}
+
+    def send_message(self, QueueUrl, MessageBody):
+        message_id = uuid.uuid4().hex
+        self.queues[QueueUrl].append({'messageId': message_id, 'body': MessageBody})
+        return {'MessageId': message_id}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        successful = [{'Id': entry['Id'], 'MessageId': self.send_message(QueueUrl, entry['MessageBody'])['MessageId']}
+                      for entry in Entries]
+        return {'Successful': successful, 'Failed': []}
+
+    def receive(self, name, max_messages):
+        """
+        Takes up to max_messages off the queue, as the records of a lambda event
+        """
+        queue = self.queues[self.queue_url(name)]
+        records = []
+        while queue and len(records) < max_messages:
+            records.append(dict(queue.popleft(), eventSourceARN=self.queue_arn(name)))
+        return records
+
+
+class FakeContext:
+
+    def __init__(self, timeout):
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+latencies = []  # seconds taken by every row scanned by the asyncio engine in this process
+original_request = handler.request
+original_async_request = handler.async_request
+
+
+def timed_request(latency_dir, rows, **kwargs):
+    """
+    Stands in for get_robots.request in the multiproc workers, scans the rows one at a time to time them.
+    The workers are separate processes, each appends its latencies to its own file in latency_dir
+    """
+    results = []
+    times = []
+    for row in rows:
+        started = time.perf_counter()
+        results.extend(original_request([row], **kwargs))
+        times.append(time.perf_counter() - started)
+    with open(os.path.join(latency_dir, str(os.getpid())), 'a') as f:
+        f.write(''.join(f"{seconds}\n" for seconds in times))
+    return results
+
+
+async def timed_async_request(row, timeout, **kwargs):
+    started = time.perf_counter()
+    try:
+        return await original_async_request(row, timeout, **kwargs)
+    finally:
+        latencies.append(time.perf_counter() - started)
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status", 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+class MemorySampler(threading.Thread):
+    """
+    Samples the resident memory of this process plus its multiproc workers, which together are what counts
+    against the lambda's memory. Needs /proc (Linux), peak stays None without it
+    """
+
+    def __init__(self, interval=0.05):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        if not os.path.exists(f"/proc/{os.getpid()}/status"):
+            return
+        while not self.stopped.wait(self.interval):
+            pids = [os.getpid()]
+            if lambda_multiproc.pool is not None:
+                pids.extend(process.pid for process, conn in lambda_multiproc.pool.workers)
+            total = 0
+            for pid in pids:
+                try:
+                    total += rss_kb(pid)
+                except (OSError, ValueError):
+                    pass  # worker exited in between
+            self.peak = max(self.peak or 0, total)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[int(round(fraction * (len(ordered) - 1)))] if ordered else None
+
+
+def drain_queues(sqs, batch_size, function_timeout):
+    """
+    Invokes the handler on batches of up to batch_size messages, the queue first, then the slow lane queue,
+    until both are empty. Returns the number of invocations and of chunks reported in batchItemFailures
+    (the simulation doesn't redeliver these)
+    """
+    num_invocations = 0
+    failed_chunks = 0
+    while True:
+        records = sqs.receive(queue_name, batch_size) or sqs.receive(slow_queue_name, batch_size)
+        if not records:
+            return num_invocations, failed_chunks
+        response = handler.get_robots({'Records': records}, FakeContext(function_timeout))
+        num_invocations += 1
+        failed_chunks += len(response['batchItemFailures'])
+
+
+def run(**settings):
+    """
+    Runs one simulated scan, settings override default_settings
+    :return
+        dict of the report, see the end of this function
+    """
+    settings = dict(default_settings, **settings)
+    config = invocations.get_config()
+    batch_size = int(config['custom']['batchSize'])
+    function_timeout = int(config['custom']['functionTimeout'])
+
+    s3 = FakeS3()
+    sqs = FakeSQS([queue_name, slow_queue_name])
+    clients = {'s3': s3, 'sqs': sqs}
+    original_boto3 = handler.boto3
+    handler.boto3 = types.SimpleNamespace(client=lambda service: clients[service])
+
+    with HostFarm(settings['delay'], settings['latency']) as farm, tempfile.TemporaryDirectory() as work_dir:
+        os.environ['layer_dir'] = work_dir
+        os.environ['bucket_name'] = bucket_name
+        os.environ['slow_queue'] = sqs.queue_url(slow_queue_name)
+        mix = write_domains(work_dir, farm, settings['domains'], settings['mix'], settings['seed'])
+        latency_dir = os.path.join(work_dir, 'latency')
+        os.makedirs(latency_dir)
+
+        # rows start at 1, after the header, which would otherwise be looked up as a domain named 'Domain'
+        scan_date = time.strftime('%Y-%m-%d', time.gmtime())
+        payloads = [{'start_pos': start_pos,
+                     'end_pos': min(start_pos + settings['per_lambda'], settings['domains'] + 1),
+                     'proc_count': settings['proc_count'],
+                     'engine': settings['engine'],
+                     'concurrency': settings['concurrency'],
+                     'chunk_size': settings['chunk_size'],
+                     'timeout': settings['timeout'],
+                     'slow_timeout': settings['slow_timeout'],
+                     'slow_concurrency': settings['slow_concurrency'],
+                     'output_format': settings['output_format'],
+                     'probes': settings['probes'],
+                     'scan_date': scan_date} for start_pos in range(1, settings['domains'] + 1, settings['per_lambda'])]
+        sqs_messages = [{'MessageBody': json.dumps(payload), 'Id': uuid.uuid4().__str__()} for payload in payloads]
+
+        del latencies[:]
+        handler.request = functools.partial(timed_request, latency_dir)
+        handler.async_request = timed_async_request
+        sampler = MemorySampler()
+        sampler.start()
+        try:
+            _start = time.time()
+            invocations.split_and_put_into_ques(message_batch=sqs_messages, que_urls=[sqs.queue_url(queue_name)],
+                                                client=sqs)
+            enqueue_seconds = time.time() - _start
+            num_invocations, failed_chunks = drain_queues(sqs, batch_size, function_timeout)
+            seconds = time.time() - _start
+        finally:
+            handler.boto3 = original_boto3
+            handler.request = original_request
+            handler.async_request = original_async_request
+            peak_kb = sampler.stop()
+            if lambda_multiproc.pool is not None:
+                lambda_multiproc.pool.close()  # every run starts with a cold container
+
+        row_latencies = list(latencies)
+        for file_name in os.listdir(latency_dir):
+            with open(os.path.join(latency_dir, file_name), 'r') as f:
+                row_latencies.extend(float(line) for line in f)
+
+    statuses = s3.read_json(handler.status_prefix)
+    metrics = scan_metrics.new()
+    for invocation in s3.read_json(scan_metrics.metrics_prefix):
+        scan_metrics.merge(metrics, invocation['metrics'])
+    domains = sum(status['domains'] for status in statuses if status['lane'] == 'fast')
+    answering = [profile for profile in farm_profiles if profile not in ('timeout', 'refused')]
+    expected = sum(mix[profile] for profile in (answering if 'headers' in settings['probes'] else found_profiles))
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    process_peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+
+    report = {'settings': settings,
+              'mix': dict(mix),
+              'chunks': len(sqs_messages),
+              'invocations': num_invocations,
+              'failed_chunks': failed_chunks,
+              'domains': domains,
+              'records': sum(status['records'] for status in statuses),
+              'expected_records': expected,
+              'failures': sum(status['failures'] for status in statuses if status['lane'] == 'fast'),
+              'slow_lane_chunks': sum(1 for status in statuses if status['lane'] == 'slow'),
+              'enqueue_seconds': round(enqueue_seconds, 3),
+              'seconds': round(seconds, 3),
+              'domains_per_second': round(domains / seconds, 1) if seconds else None,
+              'latency_ms': {name: round(percentile(row_latencies, fraction) * 1000, 1) if row_latencies else None
+                             for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))},
+              'peak_rss_mb': round(max(peak_kb or 0, process_peak_kb) / 1024, 1),
+              'stored_mb': round(sum(len(body) for body in s3.objects.values()) / 1024 / 1024, 3),
+              'requests': scan_metrics.summary(metrics)}
+    return report
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    parser = argparse.ArgumentParser(description="Scan a local farm of simulated domains with the real lambda "
+                                                 "handler, against in-process S3 and SQS. No AWS or network needed.")
+    parser.add_argument("-d", "--domains",
+                        help="Number of simulated domains, default is 2000",
+                        default=default_settings['domains'])
+    parser.add_argument("-p", "--per_lambda",
+                        help="Number of records per chunk (sqs message), default is 250",
+                        default=default_settings['per_lambda'])
+    parser.add_argument("-e", "--engine",
+                        help="Scan engine, asyncio or multiproc, default is asyncio",
+                        choices=['asyncio', 'multiproc'],
+                        default=default_settings['engine'])
+    parser.add_argument("-c", "--concurrency",
+                        help="Number of requests in flight (asyncio engine), default is 500",
+                        default=default_settings['concurrency'])
+    parser.add_argument("-m", "--multiproc_count",
+                        help="Number of processes (multiproc engine), default is 125",
+                        default=default_settings['proc_count'])
+    parser.add_argument("--chunk_size",
+                        help="Number of rows handed to a process at a time (multiproc engine), default is 1",
+                        default=default_settings['chunk_size'])
+    parser.add_argument("-t", "--timeout",
+                        help="Per-request timeout in seconds, default is 1.5",
+                        default=default_settings['timeout'])
+    parser.add_argument("-s", "--slow_timeout",
+                        help="Timeout in seconds of the slow lane, 0 disables it, default is 5",
+                        default=default_settings['slow_timeout'])
+    parser.add_argument("-o", "--output_format",
+                        help="Format of result files, jsonl, jsonl.gz or parquet, default is jsonl",
+                        choices=['jsonl', 'jsonl.gz', 'parquet'],
+                        default=default_settings['output_format'])
+    parser.add_argument("--probes",
+                        help="What to request from every domain, default is robots.txt",
+                        nargs='+',
+                        default=default_settings['probes'])
+    parser.add_argument("--mix",
+                        help=f"Weights of the domain profiles, default is {default_mix}. Profiles: " +
+                             "; ".join(f"{name}: {description}" for name, description in farm_profiles.items()),
+                        default=default_settings['mix'])
+    parser.add_argument("--delay",
+                        help="Seconds every response is delayed by, default is 0.02",
+                        default=default_settings['delay'])
+    parser.add_argument("--latency",
+                        help="Extra seconds responses of slow domains are delayed by, default is 0.5",
+                        default=default_settings['latency'])
+    parser.add_argument("--seed",
+                        help="Seed of the random spread of domains over profiles, default is 0",
+                        default=default_settings['seed'])
+    parser.add_argument("-v", "--verbose",
+                        help="Show the lambda's log",
+                        action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger('main_logger').setLevel(logging.CRITICAL)
+
+    report = run(domains=int(args.domains),
+                 per_lambda=int(args.per_lambda),
+                 engine=args.engine,
+                 concurrency=int(args.concurrency),
+                 proc_count=int(args.multiproc_count),
+                 chunk_size=int(args.chunk_size),
+                 timeout=float(args.timeout),
+                 slow_timeout=float(args.slow_timeout),
+                 output_format=args.output_format,
+                 probes=args.probes,
+                 mix=args.mix,
+                 delay=float(args.delay),
+                 latency=float(args.latency),
+                 seed=int(args.seed))
+
+    logger.info(f"Scanned {report['domains']:,} domains in {report['seconds']}s "
+                f"({report['domains_per_second']} domains/s) with {report['invocations']} invocations")
+    logger.info(f"Found {report['records']:,} records (expected {report['expected_records']:,}), "
+                f"{report['failures']} failures retried in {report['slow_lane_chunks']} slow lane chunks, "
+                f"{report['failed_chunks']} chunks failed")
+    logger.info(f"Row latency ms: {report['latency_ms']}, peak RSS {report['peak_rss_mb']}MB")
+    print(json.dumps(report, indent=2))